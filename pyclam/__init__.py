@@ -1,4 +1,5 @@
 from . import criterion
 from . import types
 from . import datasets
+from . import scoring
 from .manifold import Manifold, Graph, Cluster
@@ -1,6 +1,9 @@
+import heapq
+import itertools
 import logging
+import time
 from abc import ABC, abstractmethod
-from typing import Set, Tuple, List
+from typing import Set, Tuple, List, Union, Iterable
 
 import numpy as np
 from scipy.spatial.distance import cdist
@@ -17,6 +20,15 @@ class Criterion(ABC):
 
 
 class ClusterCriterion(Criterion):
+    """ Decides whether a cluster may be partitioned.
+
+    A criterion may also define a method:
+        batch(clusters, *, depths, cardinalities, radii, lfds) -> np.ndarray
+    that evaluates the criterion for a whole layer of clusters at once.
+    It receives the list of clusters and arrays of their properties, and returns a boolean mask.
+    Radii and lfds are only computed when some batch method names them among its keyword arguments.
+    Manifold uses it when building the tree and falls back to __call__ for criteria without one.
+    """
 
     @abstractmethod
     def __call__(self, cluster: Cluster) -> bool:
@@ -47,6 +59,9 @@ class MaxDepth(ClusterCriterion):
     def __call__(self, cluster: Cluster) -> bool:
         return cluster.depth < self.depth
 
+    def batch(self, clusters: List[Cluster], *, depths: np.ndarray, **kwargs) -> np.ndarray:
+        return depths < self.depth
+
 
 class AddLevels(ClusterCriterion):
     """ Allows clustering up until current.depth + depth.
@@ -61,6 +76,11 @@ class AddLevels(ClusterCriterion):
             self.start = cluster.depth
         return cluster.depth < (self.start + self.depth)
 
+    def batch(self, clusters: List[Cluster], *, depths: np.ndarray, **kwargs) -> np.ndarray:
+        if self.start is None and len(depths) > 0:
+            self.start = int(depths[0])
+        return depths < (self.start + self.depth)
+
 
 class MinPoints(ClusterCriterion):
     """ Allows clustering up until there are fewer than points.
@@ -72,6 +92,9 @@ class MinPoints(ClusterCriterion):
     def __call__(self, cluster: Cluster) -> bool:
         return cluster.cardinality > self.min_points
 
+    def batch(self, clusters: List[Cluster], *, cardinalities: np.ndarray, **kwargs) -> np.ndarray:
+        return cardinalities > self.min_points
+
 
 class MinRadius(ClusterCriterion):
     """ Allows clustering until cluster.radius is less than radius.
@@ -83,6 +106,9 @@ class MinRadius(ClusterCriterion):
     def __call__(self, cluster: Cluster) -> bool:
         return cluster.radius > self.radius
 
+    def batch(self, clusters: List[Cluster], *, radii: np.ndarray, **kwargs) -> np.ndarray:
+        return radii > self.radius
+
 
 class MedoidNearCentroid(ClusterCriterion):
     def __init__(self):
@@ -96,6 +122,14 @@ class MedoidNearCentroid(ClusterCriterion):
             distance > (cluster.radius * 0.1)
         ))
 
+    def batch(self, clusters: List[Cluster], *, depths: np.ndarray, radii: np.ndarray, **kwargs) -> np.ndarray:
+        if len(clusters) == 0:
+            return np.zeros(shape=(0,), dtype=bool)
+        manifold = clusters[0].manifold
+        centroids = np.stack([cluster.centroid for cluster in clusters])
+        distances = manifold.paired_distance(centroids, [cluster.argmedoid for cluster in clusters])
+        return (depths < 1) | (distances > (radii * 0.1))
+
 
 class UniformDistribution(ClusterCriterion):
     def __init__(self):
@@ -110,6 +144,34 @@ class UniformDistribution(ClusterCriterion):
         distance = wasserstein_distance(freq, ideal)
         return distance > 0.25
 
+    def batch(self, clusters: List[Cluster], *, radii: np.ndarray, **kwargs) -> np.ndarray:
+        if len(clusters) == 0:
+            return np.zeros(shape=(0,), dtype=bool)
+        manifold = clusters[0].manifold
+        bins = np.asarray([i / 10 for i in range(1, 10)])
+
+        # distances from the samples of all clusters to their own medoids, in one pass.
+        counts = np.asarray([cluster.nsamples for cluster in clusters])
+        segments = np.repeat(np.arange(len(clusters)), counts)
+        argsamples = [p for cluster in clusters for p in cluster.argsamples]
+        argmedoids = np.repeat([cluster.argmedoid for cluster in clusters], counts)
+        distances = manifold.paired_distance(argmedoids, argsamples, metric='euclidean') / (radii[segments] + 1e-15)
+
+        # same binning as numpy.histogram, whose last bin includes its right edge.
+        indices = np.searchsorted(bins, distances, side='right') - 1
+        indices[distances == bins[-1]] = bins.shape[0] - 2
+        valid = (indices >= 0) & (indices < bins.shape[0] - 1)
+        freq = np.bincount(
+            segments[valid] * (bins.shape[0] - 1) + indices[valid],
+            minlength=len(clusters) * (bins.shape[0] - 1),
+        ).reshape(len(clusters), bins.shape[0] - 1)
+
+        # the wasserstein distance to a constant distribution of equal size is the mean absolute difference.
+        # the ideal count is floored, as np.full_like does with the integer frequencies in __call__.
+        ideal = counts // bins.shape[0]
+        distance = np.mean(np.abs(freq - ideal[:, None]), axis=1)
+        return distance > 0.25
+
 
 class Leaves(SelectionCriterion):
     def __init__(self):
@@ -175,9 +237,9 @@ class LFDRange(SelectionCriterion):
 
         while active or inactive:
             # Select childless clusters from inactive set
-            childless: Set[Cluster] = {cluster for cluster in inactive if len(cluster.children) == 0}
+            childless: Set[Cluster] = {cluster for cluster in inactive if not cluster.children}
             # Select childless clusters from active set
-            childless.update({cluster for cluster in active if len(cluster.children) == 0})
+            childless.update({cluster for cluster in active if not cluster.children})
             selected.update(childless)
             inactive -= childless
             active -= childless
@@ -253,90 +315,144 @@ def _find_parents_to_remove(graph: Graph) -> Set[Cluster]:
 class MinimizeSubsumed(GraphCriterion):
     """
     Minimize fraction of subsumed clusters in the graph.
-    Terminate early if fraction subsumed falls under the given threshold.
+    Terminate early if fraction subsumed falls under the given threshold,
+    or when the budget of iterations or of seconds runs out.
+
+    Two moves are tried, highest priority first, from a priority-queue each:
+        split a walkable cluster that subsumes the most clusters into its children, and
+        merge children, that are all in the graph and subsumed, into their parent.
+    A parent that was split or merged is not moved again, so no move is ever undone.
+    Each iteration makes a batch of independent moves with one call to Graph.replace_clusters,
+    and only clusters in the neighborhood of those moves are re-queued.
     """
-    def __init__(self, fraction: float):
+    def __init__(self, fraction: float, max_iterations: int = None, max_seconds: float = None):
+        """
+        :param fraction: fraction of subsumed clusters under which to stop.
+        :param max_iterations: Optional. Maximum number of calls to Graph.replace_clusters.
+        :param max_seconds: Optional. Maximum time to spend, checked between iterations.
+        """
         if not (0. < fraction < 1.):
             raise ValueError(f'fraction must be between 0 and 1. Got {fraction:.2f}')
+        if max_iterations is not None and max_iterations < 0:
+            raise ValueError(f'max_iterations must not be negative. Got {max_iterations}')
+        if max_seconds is not None and max_seconds < 0:
+            raise ValueError(f'max_seconds must not be negative. Got {max_seconds}')
 
         self.fraction: float = max(fraction, 1e-3)
+        self.max_iterations: Union[int, None] = max_iterations
+        self.max_seconds: Union[float, None] = max_seconds
 
     def __call__(self, manifold: Manifold) -> Manifold:
-        fractions: List[float]
-        uppers: List[float] = list()
-        lowers: List[float] = list()
-        count: int = 0
-
-        def _steady(fraction: float, tolerance: int):
-            # fraction of subsumed clusters has held steady for some iterations
-            uppers.append(max(fractions[-tolerance:]))
-            lowers.append(max(fractions[-tolerance:]))
-            upper_upper = max(uppers[-tolerance:])
-            upper_lower = min(uppers[-tolerance:])
-            lower_upper = max(lowers[-tolerance:])
-            lower_lower = min(lowers[-tolerance:])
-            return all((
-                len(fractions) > tolerance,
-                (upper_upper - upper_lower) < (fraction / 10),
-                (lower_upper - lower_lower) < (fraction / 10),
-            ))
-
-        def minimized_subsumed_log(_clusters: Set[Cluster]):
-            depths = {cluster.depth for cluster in _clusters}
+        manifold._mutable('minimize subsumed clusters in')
+        graph: Graph = manifold.graph
+        start = time.monotonic()
+        counter = itertools.count()
+
+        splits: List[Tuple[int, int, Cluster]] = list()
+        merges: List[Tuple[Tuple[int, float], int, Cluster]] = list()
+        # parents that were split or merged, which are not to be moved again.
+        frozen: Set[Cluster] = set()
+
+        def split_priority(cluster: Cluster) -> Union[int, None]:
+            # walkable clusters that subsume others, by most subsumed neighbors.
+            if (cluster in graph
+                    and cluster.children
+                    and cluster not in frozen
+                    and cluster in graph.walkable_clusters):
+                subsumed = len(graph.neighbors(cluster, choice='subsumed'))
+                return -subsumed if subsumed > 0 else None
+            return None
+
+        def merge_priority(parent: Cluster) -> Union[Tuple[int, float], None]:
+            # parents whose children are all in the graph, by most subsumed children and then by smallest radius.
+            if (parent not in frozen
+                    and parent not in graph
+                    and parent.children
+                    and all(child in graph for child in parent.children)):
+                subsumed = sum(1 for child in parent.children if child in graph.subsumed_clusters)
+                return (-subsumed, parent.radius) if subsumed > 0 else None
+            return None
+
+        def push(clusters: Iterable[Cluster]):
+            for cluster in clusters:
+                priority = split_priority(cluster)
+                if priority is not None:
+                    heapq.heappush(splits, (priority, next(counter), cluster))
+                if cluster.depth > 0 and cluster in graph.subsumed_clusters:
+                    parent = cluster.parent
+                    priority = merge_priority(parent)
+                    if priority is not None:
+                        heapq.heappush(merges, (priority, next(counter), parent))
+
+        def pop(queue: list, priority_function, size: int) -> List[Cluster]:
+            # pops up to size clusters whose priorities are still current.
+            chosen: List[Cluster] = list()
+            while queue and len(chosen) < size:
+                priority, _, cluster = heapq.heappop(queue)
+                current = priority_function(cluster)
+                if current is None or cluster in chosen:
+                    continue
+                elif current != priority:
+                    heapq.heappush(queue, (current, next(counter), cluster))
+                else:
+                    chosen.append(cluster)
+            return chosen
+
+        def fraction() -> float:
+            return len(graph.subsumed_clusters) / graph.cardinality
+
+        def minimized_subsumed_log():
+            depths = {cluster.depth for cluster in graph.clusters}
             logging.info(f"depths: ({min(depths)}, {max(depths)}), "
-                         f"clusters: {manifold.graph.cardinality}, "
-                         f"fraction_subsumed: {fractions[-1]:.4f}")
+                         f"clusters: {graph.cardinality}, "
+                         f"fraction_subsumed: {fraction():.4f}")
 
-        fractions = [len(manifold.graph.subsumed_clusters) / manifold.graph.cardinality]
-        minimized_subsumed_log(set(manifold.graph.clusters))
+        push(graph.clusters)
+        minimized_subsumed_log()
 
-        choices: Set[Cluster] = set()
-
-        while fractions[-1] > self.fraction:
-            if _steady(self.fraction, 5):
+        iteration = 0
+        while fraction() > self.fraction and (splits or merges):
+            if self.max_iterations is not None and iteration >= self.max_iterations:
+                logging.info(f'stopping after {iteration} iterations')
+                break
+            if self.max_seconds is not None and time.monotonic() - start >= self.max_seconds:
+                logging.info(f'stopping after {time.monotonic() - start:.2f} seconds')
                 break
-            count += 1
-            if count % 100 == 0:
-                count = 0
-                fractions.append(len(manifold.graph.subsumed_clusters) / manifold.graph.cardinality)
-                choices = set()
-                minimized_subsumed_log(set(manifold.graph.clusters))
-
-            # the set of those parents whose children are all subsumed
-            choices: Set[Cluster] = set(manifold.graph.clusters) - choices
+            iteration += 1
+
+            # moves in a batch must not touch the same clusters.
+            size = max(1, graph.cardinality // 100)
             removals: Set[Cluster] = set()
             additions: Set[Cluster] = set()
-
-            parents: Set[Cluster] = {
-                cluster.parent for cluster in choices
-                if cluster.parent.children.issubset(manifold.graph.clusters)
+            for cluster in pop(splits, split_priority, size):
+                removals.add(cluster)
+                additions.update(cluster.children)
+                frozen.add(cluster)
+            for parent in pop(merges, merge_priority, size):
+                if removals.isdisjoint(parent.children):
+                    removals.update(parent.children)
+                    additions.add(parent)
+                    frozen.add(parent)
+            if not removals:
+                continue
+
+            neighbors: Set[Cluster] = {
+                neighbor for cluster in removals
+                for neighbor in graph.neighbors(cluster)
+                if neighbor not in removals
             }
-
-            if parents:
-                # choose parent with largest radius by children
-                samples = list(sorted(parents, key=lambda p: p.radius))
-                choice: Set[Cluster] = set(samples[:len(samples) // 2])
-                removals.update({child for c in choice for child in c.children})
-                additions.update(choice)
-                choices.update(removals)
-
-            # set of parent clusters that are also walkable clusters
-            parents = {cluster for cluster in manifold.graph.walkable_clusters
-                       if (cluster not in choices) and cluster.children}
-
-            if parents:
-                # choose to replace cluster with the most edges
-                samples = list(sorted(parents, key=lambda p: len(manifold.graph.subsumed_edges[p])))
-                choice: Set[Cluster] = set(samples[:len(samples) // 4])
-                removals.update(choice)
-                additions.update({child for c in choice for child in c.children})
-                choices.update(additions)
-
-            manifold.graph.replace_clusters(
+            graph.replace_clusters(
                 removals=removals,
                 additions=additions,
                 recompute_probabilities=True,
             )
 
-        # manifold.graph.recompute_transition_probabilities()
+            neighbors.update(additions)
+            neighbors.update({neighbor for cluster in additions for neighbor in graph.neighbors(cluster)})
+            push(neighbors)
+
+            if iteration % 100 == 0:
+                minimized_subsumed_log()
+
+        minimized_subsumed_log()
         return manifold
@@ -1,20 +1,37 @@
 """ Clustered Learning of Approximate Manifolds.
 """
 import concurrent.futures
+import heapq
+import inspect
 import logging
 import pickle
+import sys
+import threading
 import warnings
-from collections import deque
-from operator import itemgetter
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from functools import reduce
+from itertools import chain, combinations_with_replacement
+from operator import itemgetter, xor
 from typing import Set, Dict, Iterable, BinaryIO, List, Union, Tuple, IO, Any
 
 import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
 from scipy.spatial.distance import cdist
 
-from pyclam.types import Data, Radius, Vector, Metric, Edge, CacheEdge
+from pyclam.types import Data, Radius, Vector, Metric, Edge, CacheEdge, Adjacency, Plan
 
 SUBSAMPLE_LIMIT = 100
 BATCH_SIZE = 10_000
+BEST_FIRST_WIDTH = 16
+# Query planning: the most clusters to probe at one depth, and the costs, in distance evaluations,
+# of visiting one cluster during tree search and of scanning one point in a linear scan.
+PLAN_WIDTH = 32
+PLAN_CLUSTER_COST = 50.
+PLAN_LINEAR_COST = 0.5
+DISTANCE_CACHE_SIZE = 1_000_000
 LOG_LEVEL = logging.INFO
 
 logging.basicConfig(
@@ -50,6 +67,9 @@ class Cluster:
         self.name: str = name
         self.children: Union[None, List['Cluster']] = None
 
+        # Compact integer id, unique among clusters of the manifold. manifold.clusters[cluster.id] is the cluster.
+        self.id: int = manifold._register(self)
+
         # Reference to the distance function for easier usage
         self.distance = self.manifold.distance
 
@@ -60,6 +80,9 @@ class Cluster:
         #     self.distance_from([candidate.argmedoid]) <= candidate.radius + self.radius * 4
         self.candidates: Union[Dict['Cluster', float], None] = None
 
+        # Held while the cluster is lazily partitioned, so that clusters in other subtrees expand in parallel.
+        self.lock: threading.Lock = threading.Lock()
+
         self.cache: Dict[str, Any] = dict()
         self.cache.update(**kwargs)
 
@@ -73,7 +96,12 @@ class Cluster:
         return
 
     def __eq__(self, other: 'Cluster') -> bool:
-        """ Two clusters are identical if they have the same name and the same set of points. """
+        """ Two clusters are identical if they have the same name and the same set of points.
+
+        Within one manifold, names and ids go together, so only ids are compared.
+        """
+        if self.manifold is other.manifold:
+            return self.id == other.id
         return all((
             self.name == other.name,
             set(self.argpoints) == set(other.argpoints),
@@ -212,7 +240,10 @@ class Cluster:
 
             argradii_radii = [argmax_max(batch) for batch in iter(self)]
             argradius, radius = max(argradii_radii, key=itemgetter(1))
-            self.cache['argradius'], self.cache['radius'] = int(argradius), float(radius)
+            # A cached radius may be larger than the recomputed one after points were deleted.
+            # Keeping the larger value leaves it a valid upper bound for anything computed from it.
+            self.cache['argradius'] = int(argradius)
+            self.cache['radius'] = max(float(radius), self.cache.get('radius', 0.))
         return self.cache['argradius']
 
     @property
@@ -241,8 +272,13 @@ class Cluster:
         return self.cache['local_fractal_dimension']
 
     def clear_cache(self) -> None:
-        """ Clears the cache for the cluster. """
+        """ Clears the cache for the cluster.
+
+        The medoid is chosen again on the next access, so cached distances from its medoid are dropped as well.
+        """
         logging.debug(f'clearing cache for {self}')
+        if 'argmedoid' in self.cache:
+            self.manifold._evict_distances(self.id)
         self.cache.clear()
         return
 
@@ -275,12 +311,17 @@ class Cluster:
         :param criterion: criteria to use to determine if a Cluster can be partitioned.
         :return: List of children.
         """
+        self.children = self._split(*criterion)
+        return self.children
+
+    def _split(self, *criterion) -> Union[List['Cluster'], Set['Cluster']]:
+        """ Returns the children into which the cluster would be partitioned, without setting them as its children. """
         if not all((
             len(self.argsamples) > 1,
             *(c(self) for c in criterion),
         )):  # cluster cannot be partitioned
             logging.debug(f'{self} cannot be partitioned.')
-            self.children = list()
+            children = list()
         else:
             poles: List[int] = self._find_poles()
             child_argpoints: List[List[int]] = [[p] for p in poles]
@@ -292,13 +333,18 @@ class Cluster:
                     [child_argpoints[int(np.argmin(row))].append(p) for p, row in zip(argpoints, distances)]
 
             child_argpoints.sort(key=len)
-            self.children = {
+            children = {
                 Cluster(self.manifold, argpoints, self.name + '0' + '1' * i)
                 for i, argpoints in enumerate(child_argpoints)
             }
-            logging.debug(f'{self} was partitioned into {len(self.children)} child clusters.')
+            logging.debug(f'{self} was partitioned into {len(children)} child clusters.')
 
-        return self.children
+        return children
+
+    def _fill_cache(self) -> None:
+        """ Computes and caches the properties that searches read. """
+        _ = self.depth, self.argmedoid, self.argradius, self.radius, self.local_fractal_dimension
+        return
 
     def _tree_search(self, point: Data, radius: Radius, depth: int) -> Dict['Cluster', Radius]:
         distance = self.distance_from(np.asarray([point]))[0]
@@ -309,6 +355,9 @@ class Cluster:
         results: Dict['Cluster', Radius] = dict()
         candidates: Dict['Cluster', Radius] = {self: distance}
         for _ in range(self.depth, depth):
+            # clusters left behind by a lazy build are partitioned the first time a search reaches them.
+            [self.manifold._expand(cluster) for cluster in candidates if cluster.children is None]
+
             # if cluster was not partitioned any further, add it to results.
             results.update({cluster: distance for cluster, distance in candidates.items() if not cluster.children})
 
@@ -342,7 +391,8 @@ class Cluster:
         """ Searches down the tree for clusters that overlap point with radius at depth. """
         logging.debug(f'tree_search(point={point}, radius={radius}, depth={depth}')
         if depth == -1:
-            depth = len(self.manifold.layers)
+            # a lazily built tree has no known depth, so search as deep as it goes.
+            depth = self.manifold.depth + 1 if self.manifold.lazy_criteria is None else sys.maxsize
         if depth < self.depth:
             raise ValueError('depth must not be less than cluster.depth')
 
@@ -379,24 +429,96 @@ class Cluster:
         return Cluster(manifold, children=children, **data)
 
 
+def _fingerprint(clusters: Iterable[Cluster]) -> int:
+    """ Combines the hashes of clusters, regardless of their order. """
+    return reduce(xor, map(hash, clusters), 0)
+
+
+def _segments(indptr: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Gathers the positions of the entries in the given rows of compressed-sparse-row arrays.
+
+    :return: tuple of the index, into rows, of the row owning each entry, and the position of each entry.
+    """
+    counts = indptr[rows + 1] - indptr[rows]
+    owners = np.repeat(np.arange(len(rows)), counts)
+    positions = np.repeat(indptr[rows] - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+    return owners, positions
+
+
+def _random_walks(
+        indices: np.ndarray,
+        cumulative: np.ndarray,
+        last: np.ndarray,
+        walks: np.ndarray,
+        steps: int,
+        seed: Union[int, np.random.SeedSequence],
+) -> np.ndarray:
+    """ Advances all walkers one step at a time and counts visits to each row, see Graph.walk_table. """
+    rng = np.random.default_rng(seed)
+    counts = np.zeros(shape=(len(last),), dtype=np.int64)
+    for _ in range(steps):
+        # update walk locations
+        positions = np.searchsorted(cumulative, walks + rng.random(len(walks)), side='right')
+        walks = indices[np.minimum(positions, last[walks])]
+        # increment visit counts
+        counts += np.bincount(walks, minlength=len(last))
+    return counts
+
+
+class EdgeView(Mapping):
+    """ A read-only view of the edges of a Graph, as a mapping from clusters to sets of Edges.
+
+    Edges are stored in arrays within the graph. A view builds the set of edges of a cluster only when it is requested.
+    """
+    def __init__(self, graph: 'Graph', choice: str):
+        """
+        :param graph: the graph whose edges to view.
+        :param choice: 'all' for edges to all neighbors, from every cluster,
+                       'walkable' for edges among walkable clusters, with transition probabilities,
+                       'subsumed' for edges to subsumed neighbors, from every cluster.
+        """
+        self.graph: 'Graph' = graph
+        self.choice: str = choice
+
+    def __getitem__(self, cluster: Cluster) -> Set[Edge]:
+        if self.choice == 'walkable' and cluster not in self.graph.walkable_clusters:
+            raise KeyError(f'{cluster} is not a walkable cluster')
+        return self.graph.edge_set(cluster, choice=self.choice)
+
+    def __iter__(self) -> Iterable[Cluster]:
+        if self.choice == 'walkable':
+            yield from (cluster for cluster in self.graph.clusters if cluster in self.graph.walkable_clusters)
+        else:
+            yield from self.graph.clusters
+
+    def __len__(self) -> int:
+        return len(self.graph.walkable_clusters) if self.choice == 'walkable' else self.graph.cardinality
+
+
 class Graph:
     """
     Nodes in the Graph are Clusters.
     Two clusters have an edge if they have overlapping volumes.
     """
-    # TODO: Write dump/load methods for Graph.
     def __init__(self, *clusters):
         logging.debug(f'Graph(clusters={[str(c) for c in clusters]})')
         assert all(isinstance(c, Cluster) for c in clusters)
 
-        # self.edges is a dictionary of:
-        #       the clusters in the graph, and
-        #       the set of edges from that cluster.
-        # An Edge is a named tuple of Neighbor, Distance, and Probability.
-        # Edge.neighbor is the neighboring cluster.
-        # Edge.distance is the distance to that neighbor.
-        # Edge.probability is used to pick an edge during a random walk.
-        self.edges: Dict[Cluster, Union[Set[Edge], None]] = {cluster: None for cluster in clusters}
+        # self.members holds the clusters in the graph, and
+        # self.index maps each cluster to its position in self.members.
+        # That position is the row of the cluster in self.adjacency.
+        self.members: List[Cluster] = list(dict.fromkeys(clusters))
+        self.index: Dict[Cluster, int] = {cluster: i for i, cluster in enumerate(self.members)}
+
+        # Order-independent hash of the clusters in the graph, kept up to date as clusters are replaced.
+        self.fingerprint: int = _fingerprint(self.members)
+
+        # self.adjacency holds the edges in compressed-sparse-row arrays.
+        # The neighbors of the cluster in row i are at adjacency.indices[indptr[i]:indptr[i + 1]],
+        # with the distances and transition probabilities to them at the same positions.
+        # Transition probabilities are only non-zero among walkable clusters.
+        # It is None until edges are built.
+        self.adjacency: Union[Adjacency, None] = None
 
         self.cache: Dict[str, Any] = dict()
         return
@@ -404,22 +526,32 @@ class Graph:
     def __eq__(self, other: 'Graph') -> bool:
         """ Two graphs are identical if they have the same clusters and edges.
         """
-        cluster_equality = set(self.clusters) == set(other.clusters)
-        if any((edges is None for edges in self.edges.values())):
-            return cluster_equality
-        else:
-            edges_equality = all((
-                set(self.edges[cluster]) == set(other.edges[cluster])
-                for cluster in self.clusters
-            ))
-        return cluster_equality and edges_equality
+        if self.cardinality != other.cardinality or self.fingerprint != other.fingerprint:
+            return False
+        if not all((cluster in other.index for cluster in self.members)):
+            return False
+        if self.adjacency is None:
+            return True
+        if other.adjacency is None:
+            other.build_edges()
+
+        # compare edges, as pairs of rows in other.
+        n = self.cardinality
+        rows = np.asarray([other.index[cluster] for cluster in self.members], dtype=np.int64)
+        left = rows[np.repeat(np.arange(n), np.diff(self.adjacency.indptr))] * n + rows[self.adjacency.indices]
+        right = np.repeat(np.arange(n), np.diff(other.adjacency.indptr)) * n + other.adjacency.indices
+        if len(left) != len(right):
+            return False
+        left_order, right_order = np.argsort(left), np.argsort(right)
+        return bool(np.array_equal(left[left_order], right[right_order])
+                    and np.array_equal(self.adjacency.distances[left_order], other.adjacency.distances[right_order]))
 
     def __bool__(self) -> bool:
         return self.cardinality > 0
 
     def __iter__(self) -> Iterable[Cluster]:
         """ An iterator over the clusters in the graph. """
-        yield from self.edges
+        yield from self.members
 
     def __str__(self) -> str:
         # Cashing value because sort can be expensive on many clusters.
@@ -434,14 +566,14 @@ class Graph:
         return self.cache['repr']
 
     def __hash__(self):
-        return hash(str(self))
+        return self.fingerprint
 
     def __contains__(self, cluster: 'Cluster') -> bool:
-        return cluster in self.clusters
+        return cluster in self.index
 
     @property
     def cardinality(self) -> int:
-        return len(self.edges)
+        return len(self.members)
 
     @property
     def population(self) -> int:
@@ -449,11 +581,11 @@ class Graph:
 
     @property
     def manifold(self) -> 'Manifold':
-        return next(iter(self.edges)).manifold
+        return self.members[0].manifold
 
     @property
     def metric(self) -> Metric:
-        return next(iter(self.edges)).metric
+        return self.members[0].metric
 
     @property
     def depth(self) -> int:
@@ -463,7 +595,19 @@ class Graph:
 
     @property
     def clusters(self) -> Iterable[Cluster]:
-        return self.edges.keys()
+        return self.index.keys()
+
+    @property
+    def edges(self) -> EdgeView:
+        """ Dict of all Clusters to set of edges to every neighbor. """
+        return EdgeView(self, 'all')
+
+    @property
+    def walkable(self) -> np.ndarray:
+        """ Boolean mask, by row, of clusters that are not subsumed by other clusters. """
+        if 'walkable' not in self.cache:
+            self.build_edges()
+        return self.cache['walkable']
 
     @property
     def subsumed_clusters(self) -> Set[Cluster]:
@@ -480,263 +624,219 @@ class Graph:
         return self.cache['walkable_clusters']
 
     @property
-    def subsumed_edges(self) -> Dict[Cluster, Set[Edge]]:
+    def subsumed_edges(self) -> EdgeView:
         """ Dict of all Clusters to set of edges to every subsumed cluster. """
-        if 'subsumed_edges' not in self.cache:
+        if self.adjacency is None:
             self.build_edges()
-        return self.cache['subsumed_edges']
+        return EdgeView(self, 'subsumed')
 
     @property
-    def walkable_edges(self) -> Dict[Cluster, Set[Edge]]:
+    def walkable_edges(self) -> EdgeView:
         """
         Walkable Clusters are those not subsumed by any other Cluster.
         These are used in graph traversals and random walks.
         """
-        if 'walkable_edges' not in self.cache:
+        if self.adjacency is None:
             self.build_edges()
-        return self.cache['walkable_edges']
-
-    def _find_candidates(self, cluster: Cluster):
-        # Dict of candidate neighbors and distances to neighbors.
-        radius: float = cluster.manifold.root.radius
-
-        ancestry: List[Cluster] = self.manifold.ancestry(cluster)
-        for depth in range(cluster.depth):
-            if ancestry[depth + 1].radius > 0:
-                radius = ancestry[depth + 1].radius
-
-            # This ensures that candidates are calculated once per cluster
-            if ancestry[depth + 1].candidates is None:
-                # Keep candidates from parent
-                candidates: Dict[Cluster, float] = {c: 0. for c in ancestry[depth].candidates}
-
-                # Get all children of candidates at the same depth.
-                candidates.update({
-                    child: 0.
-                    for c in ancestry[depth].candidates
-                    for child in c.children
-                    if c.depth == depth
-                })
-
-                if len(candidates) > 0:
-                    distances = ancestry[depth + 1].distance_from([c.argmedoid for c in candidates])
-                    ancestry[depth + 1].candidates = {
-                        c: float(d)
-                        for c, d in zip(candidates, distances)
-                        if d <= c.radius + radius * 4
-                    }
-                else:
-                    ancestry[depth + 1].candidates = dict()
+        return EdgeView(self, 'walkable')
+
+    def _find_candidates(self):
+        """ Finds candidate neighbors for every cluster in the graph that lacks them.
+
+        Candidates are found one depth at a time, for every cluster at that depth together,
+        with one distance computation between cluster medoids and the medoids of their inherited candidates.
+        Distances already computed for other graphs of the manifold are reused, see Manifold.medoid_distances.
+        """
+        manifold = self.manifold
+        if any(cluster.candidates is None for cluster in self.members):
+            # candidates are kept on the clusters, which the graphs of a manifold share.
+            manifold._mutable('find candidates in')
+
+        # clusters lacking candidates, by depth, with their parents and effective radii.
+        pending: Dict[int, Dict[Cluster, Tuple[Cluster, float]]] = dict()
+        for cluster in self.members:
+            if cluster.candidates is not None:
+                continue
+            ancestry: List[Cluster] = manifold.ancestry(cluster)
+            radius: float = manifold.root.radius
+            for parent, child in zip(ancestry[:-1], ancestry[1:]):
+                if child.radius > 0:
+                    radius = child.radius
+                if child.candidates is None:
+                    pending.setdefault(child.depth, dict())[child] = (parent, radius)
+
+        for depth in sorted(pending.keys()):
+            clusters: List[Cluster] = list(pending[depth].keys())
+            logging.debug(f'finding candidates for {len(clusters)} clusters at depth {depth}')
+
+            # Keep candidates from parent and add all children of candidates at the parent's depth.
+            candidates: List[List[Cluster]] = list()
+            for cluster in clusters:
+                parent = pending[depth][cluster][0]
+                candidates.append(list(parent.candidates) + [
+                    child
+                    for c in parent.candidates
+                    if c.depth == depth - 1
+                    for child in (c.children or [])
+                ])
+
+            counts = np.asarray(list(map(len, candidates)), dtype=np.int64)
+            sources = np.repeat(np.arange(len(clusters)), counts)
+            flat: List[Cluster] = [c for group in candidates for c in group]
+            distances = manifold.medoid_distances([clusters[i] for i in sources], flat)
+
+            radii = np.asarray([pending[depth][cluster][1] for cluster in clusters], dtype=np.float64)
+            keep = distances <= np.asarray([c.radius for c in flat], dtype=np.float64) + radii[sources] * 4
+
+            ends = np.cumsum(counts)
+            for cluster, start, end in zip(clusters, ends - counts, ends):
+                cluster.candidates = {
+                    flat[j]: float(distances[j])
+                    for j in range(start, end)
+                    if keep[j]
+                }
         return
 
-    def _find_neighbors(self, cluster: Cluster):
-        logging.debug(f'building edges for cluster {cluster.name}')
+    def _find_neighbors(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Returns the rows of clusters, of their neighbors in the graph, and the distances between them. """
+        self._find_candidates()
+
+        counts = [len(cluster.candidates) for cluster in self.members]
+        total = sum(counts)
+        sources = np.repeat(np.arange(self.cardinality), counts)
+        targets = np.fromiter(
+            (self.index.get(c, -1) for cluster in self.members for c in cluster.candidates),
+            dtype=np.int64,
+            count=total,
+        )
+        distances = np.fromiter(
+            (d for cluster in self.members for d in cluster.candidates.values()),
+            dtype=np.float64,
+            count=total,
+        )
+
+        # only keep candidates that are in the graph and that overlap with the cluster.
+        keep = targets >= 0
+        sources, targets, distances = sources[keep], targets[keep], distances[keep]
+        radii = np.asarray([cluster.radius for cluster in self.members], dtype=np.float64)
+        keep = distances <= radii[sources] + radii[targets]
+        return sources[keep], targets[keep], distances[keep]
+
+    def _symmetrize(self, sources: np.ndarray, targets: np.ndarray, distances: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Makes edges, given as arrays of rows, symmetric.
+
+        Edges from a cluster to itself are dropped, and only one distance is kept for each pair of clusters.
+        """
+        sources, targets = np.asarray(sources, dtype=np.int64), np.asarray(targets, dtype=np.int64)
+        distances = np.asarray(distances, dtype=np.float64)
 
-        if cluster.candidates is None:
-            self._find_candidates(cluster)
+        # keep the first distance found for each unordered pair of clusters.
+        keep = sources != targets
+        left, right = np.minimum(sources[keep], targets[keep]), np.maximum(sources[keep], targets[keep])
+        distances = distances[keep]
+        _, first = np.unique(left * self.cardinality + right, return_index=True)
+        left, right, distances = left[first], right[first], distances[first]
 
-        self.edges[cluster] = {
-            Edge(c, d, None)
-            for c, d in cluster.candidates.items()
-            if c in self.clusters and d <= cluster.radius + c.radius
-        }
+        # handshake between all neighbors
+        return np.concatenate([left, right]), np.concatenate([right, left]), np.concatenate([distances, distances])
+
+    def _set_adjacency(
+            self,
+            sources: np.ndarray,
+            targets: np.ndarray,
+            distances: np.ndarray,
+            probabilities: np.ndarray = None,
+    ):
+        """ Stores symmetric edges, given as arrays of rows, in the compressed-sparse-row arrays. """
+        order = np.lexsort((targets, sources))
+        indptr = np.zeros(shape=(self.cardinality + 1,), dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=self.cardinality), out=indptr[1:])
+        self.adjacency = Adjacency(
+            indptr=indptr,
+            indices=targets[order],
+            distances=distances[order],
+            probabilities=np.zeros_like(distances) if probabilities is None else probabilities[order],
+        )
         return
 
-    def split_walkable_vs_subsumed(self):
+    def _row(self, cluster: Cluster) -> slice:
+        if self.adjacency is None:
+            self.build_edges()
+        i = self.index[cluster]
+        return slice(self.adjacency.indptr[i], self.adjacency.indptr[i + 1])
+
+    def split_walkable_vs_subsumed(self, rows: Iterable[int] = None):
+        """ Marks clusters as walkable or subsumed.
+
+        :param rows: Optional. Rows of the only clusters whose neighborhoods changed since they were last marked.
+        """
         logging.debug(f'marking subsumed clusters for graph: '
                       f'depth {self.depth}, clusters : {self.cardinality}')
-        # Find the set of Subsumed Clusters.
-        self.cache['subsumed_clusters'] = {
-            cluster for cluster in self.clusters
-            for (neighbor, distance, _) in self.edges[cluster]
-            if neighbor.radius >= distance + cluster.radius
-        }
+        indptr, indices, distances, _ = self.adjacency
+        radii = np.asarray([cluster.radius for cluster in self.members], dtype=np.float64)
+
+        if rows is None:
+            rows = np.arange(self.cardinality)
+            self.cache['walkable'] = np.ones(shape=(self.cardinality,), dtype=bool)
+            self.cache['walkable_clusters'] = set(self.members)
+            self.cache['subsumed_clusters'] = set()
+        rows = np.asarray(list(rows), dtype=np.int64)
+
+        # A cluster is subsumed if any neighbor's volume contains its own.
+        owners, positions = _segments(indptr, rows)
+        subsumed = radii[indices[positions]] >= distances[positions] + radii[rows[owners]]
+        subsumed = np.bincount(owners[subsumed], minlength=len(rows)) > 0
+        self.cache['walkable'][rows] = ~subsumed
+
+        subsumed_clusters = {self.members[i] for i in rows[subsumed]}
+        walkable_clusters = {self.members[i] for i in rows[~subsumed]}
+        self.cache['walkable_clusters'].difference_update(subsumed_clusters)
+        self.cache['walkable_clusters'].update(walkable_clusters)
+        self.cache['subsumed_clusters'].difference_update(walkable_clusters)
+        self.cache['subsumed_clusters'].update(subsumed_clusters)
+        return
 
-        # walkable clusters are those that are not subsumed clusters.
-        self.cache['walkable_clusters'] = set(self.clusters) - self.cache['subsumed_clusters']
+    def recompute_transition_probabilities(self, rows: Iterable[int] = None):
+        """ Computes transition probabilities along edges among walkable clusters.
 
-        # build outgoing edges from each cluster to every neighbor subsumed by that cluster
-        self.cache['subsumed_edges'] = {
-            cluster: {
-                Edge(edge.neighbor, edge.distance, None)
-                for edge in self.edges[cluster]
-                if edge.neighbor in self.cache['subsumed_clusters']
-            } for cluster in self.clusters
-        }
+        Probabilities out of each walkable cluster are proportional to the inverse distances to its walkable neighbors.
 
-        # build outgoing edges among walkable clusters
-        self.cache['walkable_edges'] = {
-            cluster: {
-                Edge(edge.neighbor, edge.distance, None)
-                for edge in self.edges[cluster]
-                if edge.neighbor not in self.cache['subsumed_clusters']
-            } for cluster in self.clusters
-            if cluster not in self.cache['subsumed_clusters']
-        }
-        return
-
-    def recompute_transition_probabilities(self):
+        :param rows: Optional. Rows of the only clusters whose outgoing probabilities to recompute.
+        """
         logging.debug(f'computing transition probabilities for graph: '
                       f'depth {self.depth}, clusters : {self.cardinality}')
-        for cluster in self.cache['walkable_edges']:
-            # Compute transition probabilities.
-            # These only exist among walkable Clusters.
-            if len(self.cache['walkable_edges'][cluster]) > 0:
-                factor = sum((
-                    1. / distance
-                    for (_, distance, _) in self.cache['walkable_edges'][cluster]
-                ))
-                self.cache['walkable_edges'][cluster] = {
-                    Edge(neighbor, distance, 1 / (distance * factor))
-                    for (neighbor, distance, _) in self.cache['walkable_edges'][cluster]
-                }
-
-                factor = sum((probability for (_, _, probability) in self.cache['walkable_edges'][cluster]))
-                assert abs(factor - 1.) <= 1e-6, f'transition probabilities did not sum to 1 for cluster {cluster.name}. Got {factor:.8f} instead.'
+        indptr, indices, distances, probabilities = self.adjacency
+        walkable = self.cache['walkable']
+        rows = np.arange(self.cardinality) if rows is None else np.asarray(list(rows), dtype=np.int64)
+
+        owners, positions = _segments(indptr, rows)
+        probabilities[positions] = 0.
+
+        # These only exist among walkable Clusters.
+        mask = walkable[rows[owners]] & walkable[indices[positions]]
+        owners, positions = owners[mask], positions[mask]
+        weights = 1. / distances[positions]
+        totals = np.bincount(owners, weights=weights, minlength=len(rows))
+        probabilities[positions] = weights / totals[owners]
         return
 
     def build_edges(self) -> 'Graph':
         """ Calculates edges for the graph. """
-        # build edges
-        [self._find_neighbors(cluster) for cluster in self.clusters]
-
-        # handshake between all neighbors
-        [self.edges[neighbor].add(Edge(cluster, distance, None))
-         for cluster, edges in self.edges.items()
-         for (neighbor, distance, _) in edges]
-
-        # Remove edges to self
-        [self.edges[cluster].remove(Edge(cluster, 0., None))
-         for cluster, edges in self.edges.items()
-         if (cluster, 0., None) in edges]
-
+        self._set_adjacency(*self._symmetrize(*self._find_neighbors()))
         self.split_walkable_vs_subsumed()
         self.recompute_transition_probabilities()
         return self
 
-    def _demote_to_subsumed(self, cluster: Cluster):
-        self._remove_walkable(cluster)
-        self._add_subsumed(cluster)
-        return
-
-    def _promote_to_walkable(self, cluster: Cluster):
-        self._remove_subsumed(cluster)
-        self._add_walkable(cluster)
-        return
-
-    def _add_subsumed(self, cluster: Cluster):
-        # add to set of subsumed clusters
-        self.cache['subsumed_clusters'].add(cluster)
-
-        # add outgoing subsumed edges from cluster
-        self.cache['subsumed_edges'][cluster] = {
-            Edge(neighbor, distance, None)
-            for (neighbor, distance, _) in self.edges[cluster]
-            if cluster.radius >= distance + neighbor.radius
-        }
-
-        # add incoming subsumed edges from neighbors that subsume cluster
-        [self.cache['subsumed_edges'][neighbor].add(Edge(cluster, distance, None))
-         for (neighbor, distance, _) in self.edges[cluster]
-         if neighbor.radius >= distance + cluster.radius]
-
-        return
-
-    def _remove_subsumed(self, cluster: Cluster):
-        # remove incoming subsumed edges to cluster
-        [self.cache['subsumed_edges'][neighbor].remove(Edge(cluster, distance, None))
-         for (neighbor, distance, _) in self.cache['subsumed_edges'][cluster]
-         if neighbor.radius >= distance + cluster.radius]
-
-        self.cache['subsumed_clusters'].remove(cluster)
-        del self.cache['subsumed_edges'][cluster]
-        return
-
-    def _add_walkable(self, cluster: Cluster):
-        # add to set of walkable clusters
-        self.cache['walkable_clusters'].add(cluster)
-
-        # add outgoing walkable edges from cluster
-        self.cache['walkable_edges'][cluster] = {
-            Edge(neighbor, distance, None)
-            for (neighbor, distance, _) in self.edges[cluster]
-            if neighbor in self.cache['walkable_clusters']
-        }
-
-        # add incoming walkable edges from walkable neighbors
-        [self.cache['walkable_edges'][neighbor].add(Edge(cluster, distance, None))
-         for (neighbor, distance, _) in self.edges[cluster]
-         if neighbor in self.cache['walkable_clusters']]
-
-        # reset transition probabilities for all walkable neighbors
-        for (neighbor, distance, _) in self.cache['walkable_edges'][cluster]:
-            self.cache['walkable_edges'][neighbor] = {
-                Edge(edge.neighbor, edge.distance, None)
-                for edge in self.cache['walkable_edges'][neighbor]
-            }
-        return
-
-    def _remove_walkable(self, cluster: Cluster):
-        # remove from walkable edges
-        for (neighbor, distance, _) in self.cache['walkable_edges'][cluster]:
-            # reset outgoing edges from walkable neighbors
-            self.cache['walkable_edges'][neighbor] = {
-                Edge(edge.neighbor, edge.distance, None)
-                for edge in self.cache['walkable_edges'][neighbor]
-            }
-            # remove incoming edge to cluster
-            self.cache['walkable_edges'][neighbor].remove(Edge(cluster, distance, None))
-
-        self.cache['walkable_clusters'].remove(cluster)
-        del self.cache['walkable_edges'][cluster]
-        return
-
-    def _add(self, cluster: Cluster):
-        self.edges[cluster] = None
-        self._find_neighbors(cluster)
-
-        # Handshake with neighbors
-        [self.edges[neighbor].add(Edge(cluster, distance, None))
-         for (neighbor, distance, _) in self.edges[cluster]]
-
-        # Remove edge to cluster
-        if Edge(cluster, 0., None) in self.edges[cluster]:
-            self.edges[cluster].remove(Edge(cluster, 0., None))
-
-        # check if cluster subsumes any neighbor or if any neighbor subsumes cluster
-        subsumed = False
-        for (neighbor, distance, _) in self.edges[cluster]:
-            if cluster.radius >= distance + neighbor.radius:
-                # cluster subsumes neighbor, deal with possible demotions
-                if neighbor in self.cache['walkable_clusters']:
-                    self._demote_to_subsumed(neighbor)
-            elif neighbor.radius >= distance + cluster.radius:
-                # neighbor subsumes cluster
-                subsumed = True
-
-        if subsumed:
-            self._add_subsumed(cluster)
-        else:
-            self._add_walkable(cluster)
-        return
-
-    def _remove(self, cluster: Cluster):
-        if cluster in self.cache['walkable_clusters']:
-            self._remove_walkable(cluster)
-        else:
-            self._remove_subsumed(cluster)
-
-        # remove all incoming edges to cluster
-        for (neighbor, _, _) in self.edges[cluster]:
-            self.edges[neighbor] = {
-                edge for edge in self.edges[neighbor]
-                if edge.neighbor != cluster
-            }
-
-        # remove cluster and outgoing edges from graph
-        del self.edges[cluster]
-
-        return
+    @property
+    def referrers(self) -> Dict[Cluster, Set[Cluster]]:
+        """ Dict of every candidate to the clusters in the graph that hold it as a candidate. """
+        if 'referrers' not in self.cache:
+            self._find_candidates()
+            self.cache['referrers'] = dict()
+            for cluster in self.members:
+                for candidate in cluster.candidates:
+                    self.cache['referrers'].setdefault(candidate, set()).add(cluster)
+        return self.cache['referrers']
 
     def replace_clusters(
             self,
@@ -748,15 +848,20 @@ class Graph:
         Replaces clusters in 'removals' by those in 'additions'.
         The set of points of clusters being removed must be identical to the set of points of clusters being added.
 
+        If edges were built, only the edges, subsumed status and transition probabilities
+        in the neighborhood of the replaced clusters are recomputed.
+
         :param removals: set of clusters to remove from the graph
         :param additions: set of clusters to add to the graph
-        :param recompute_probabilities: whether to recompute transition probabilities
+        :param recompute_probabilities: whether to recompute transition probabilities.
+                                        If not, call recompute_transition_probabilities afterwards.
         :return:
         """
-        if not removals.issubset(set(self.clusters)):
+        self.manifold._mutable('replace clusters in a graph of')
+        if not all((cluster in self.index for cluster in removals)):
             raise ValueError(f"Cannot remove a cluster that is not present in the graph")
 
-        if any((cluster in self.clusters for cluster in additions)):
+        if any((cluster in self.index for cluster in additions)):
             raise ValueError(f"Cannot add a cluster that is already present in the graph.")
 
         points_removed = {p for cluster in removals for p in cluster.argpoints}
@@ -764,20 +869,82 @@ class Graph:
         if points_removed != points_added:
             raise ValueError(f"clusters being removed had different points compared to those being added")
 
-        # [self._remove(cluster) for cluster in removals]
-        # [self._add(cluster) for cluster in additions]
-        #
-        # if recompute_probabilities:
-        #     self.recompute_transition_probabilities()
-        clusters: Set[Cluster] = set(self.clusters)
-        clusters.difference_update(removals)
-        clusters.update(additions)
+        members: List[Cluster] = [cluster for cluster in self.members if cluster not in removals]
+        members.extend(additions)
+        self.fingerprint ^= _fingerprint(removals) ^ _fingerprint(additions)
 
-        self.cache.clear()
-        self.edges = {cluster: None for cluster in clusters}
+        if self.adjacency is None:
+            self.cache.clear()
+            self.members = members
+            self.index = {cluster: i for i, cluster in enumerate(self.members)}
+            if recompute_probabilities:
+                self.build_edges()
+            return
+
+        logging.debug(f'replacing {len(removals)} clusters by {len(additions)} clusters in graph of {self.cardinality} clusters')
+        referrers = self.referrers
+        for cluster in removals:
+            for candidate in cluster.candidates:
+                referrers[candidate].discard(cluster)
+
+        # map old rows to new rows, with -1 for removed clusters.
+        mapping = np.full(shape=(self.cardinality,), fill_value=-1, dtype=np.int64)
+        kept = np.asarray([i for i, cluster in enumerate(self.members) if cluster not in removals], dtype=np.int64)
+        mapping[kept] = np.arange(len(kept))
+
+        # keep edges between clusters that remain in the graph.
+        indptr, indices, distances, probabilities = self.adjacency
+        sources = mapping[np.repeat(np.arange(self.cardinality), np.diff(indptr))]
+        targets = mapping[indices]
+        keep = (sources >= 0) & (targets >= 0)
+        affected: Set[int] = set(map(int, sources[(sources >= 0) & (targets < 0)]))
+        walkable = self.cache['walkable']
+
+        cache = {key: self.cache[key] for key in ['walkable_clusters', 'subsumed_clusters', 'referrers']}
+        cache['walkable_clusters'].difference_update(removals)
+        cache['subsumed_clusters'].difference_update(removals)
+        cache['walkable'] = np.ones(shape=(len(members),), dtype=bool)
+        cache['walkable'][:len(kept)] = walkable[kept]
+        self.cache = cache
+        self.members = members
+        self.index = {cluster: i for i, cluster in enumerate(self.members)}
+
+        # find edges to and from the clusters being added.
+        self._find_candidates()
+        new_edges: List[Tuple[int, int, float]] = list()
+        for cluster in additions:
+            i = self.index[cluster]
+            for candidate, distance in cluster.candidates.items():
+                referrers.setdefault(candidate, set()).add(cluster)
+                if candidate in self.index and distance <= cluster.radius + candidate.radius:
+                    new_edges.append((i, self.index[candidate], distance))
+            for referrer in referrers.get(cluster, set()):
+                distance = referrer.candidates[cluster]
+                if distance <= cluster.radius + referrer.radius:
+                    new_edges.append((self.index[referrer], i, distance))
+        new_edges = np.asarray(new_edges, dtype=np.float64).reshape(-1, 3)
+        new_sources, new_targets, new_distances = self._symmetrize(
+            new_edges[:, 0].astype(np.int64),
+            new_edges[:, 1].astype(np.int64),
+            new_edges[:, 2],
+        )
+        affected.update(map(int, new_sources))
+        affected.update(range(len(kept), self.cardinality))
+
+        self._set_adjacency(
+            np.concatenate([sources[keep], new_sources]),
+            np.concatenate([targets[keep], new_targets]),
+            np.concatenate([distances[keep], new_distances]),
+            np.concatenate([probabilities[keep], np.zeros_like(new_distances)]),
+        )
+        self.split_walkable_vs_subsumed(rows=sorted(affected))
 
         if recompute_probabilities:
-            self.build_edges()
+            # probabilities out of a cluster depend on which of its neighbors are walkable.
+            indptr, indices = self.adjacency.indptr, self.adjacency.indices
+            rows: Set[int] = set(affected)
+            [rows.update(map(int, indices[indptr[i]:indptr[i + 1]])) for i in affected]
+            self.recompute_transition_probabilities(rows=sorted(rows))
 
         return
 
@@ -786,56 +953,155 @@ class Graph:
         """ Returns all edges within the graph. """
         if 'edges' not in self.cache:
             logging.debug(f'building edges cache for {self}')
-            if any((edges is None for edges in self.edges.values())):
+            if self.adjacency is None:
                 self.build_edges()
 
             self.cache['edges'] = {
                 CacheEdge(cluster, *edge)
-                for cluster, edges in self.edges.items()
-                for edge in edges
+                for cluster in self.clusters
+                for edge in self.edges[cluster]
             }
 
         return self.cache['edges']
 
+    @property
+    def components(self) -> np.ndarray:
+        """ Label, by row, of the connected component to which each cluster belongs.
+
+        Walkable clusters are labelled by components of the walkable edges.
+        A subsumed cluster takes the smallest label among its walkable neighbors,
+        or a label of its own if it has none.
+        """
+        if 'components' not in self.cache:
+            if self.adjacency is None:
+                self.build_edges()
+            indptr, indices = self.adjacency.indptr, self.adjacency.indices
+            sources = np.repeat(np.arange(self.cardinality), np.diff(indptr))
+            walkable = self.walkable
+
+            mask = walkable[sources] & walkable[indices]
+            matrix = sparse.csr_matrix(
+                (np.ones(shape=(np.count_nonzero(mask),), dtype=np.int8), (sources[mask], indices[mask])),
+                shape=(self.cardinality, self.cardinality),
+            )
+            _, labels = csgraph.connected_components(matrix, directed=False)
+
+            components = np.full(shape=(self.cardinality,), fill_value=self.cardinality, dtype=np.int64)
+            _, components[walkable] = np.unique(labels[walkable], return_inverse=True)
+            mask = walkable[sources] & ~walkable[indices]
+            np.minimum.at(components, indices[mask], components[sources[mask]])
+
+            orphans = components == self.cardinality
+            components[orphans] = np.max(components[~orphans], initial=-1) + 1 + np.arange(np.count_nonzero(orphans))
+            self.cache['components'] = components
+        return self.cache['components']
+
+    def _component(self, label: int) -> 'Graph':
+        if 'subgraphs_by_label' not in self.cache:
+            self.cache['subgraphs_by_label'] = dict()
+        if label not in self.cache['subgraphs_by_label']:
+            rows = np.flatnonzero(self.components == label)
+            self.cache['subgraphs_by_label'][label] = Graph(*[self.members[i] for i in rows])
+        return self.cache['subgraphs_by_label'][label]
+
     @property
     def subgraphs(self) -> Set['Graph']:
         """ Returns all subgraphs within the graph. """
-        if any((edges is None for edges in self.edges.values())):
-            self.build_edges()
-
         if 'subgraphs' not in self.cache:
-            self.cache['subgraphs'] = set()
-
-            unvisited: Set[Cluster] = {
-                cluster for cluster in self.walkable_clusters
-            }
-            while unvisited:
-                component = self.traverse(unvisited.pop())
-                unvisited = {
-                    cluster for cluster in unvisited
-                    if cluster not in component
-                }
-
-                self.cache['subgraphs'].add(Graph(*component))
+            components = self.components
+            order = np.argsort(components, kind='stable')
+            labels, starts = np.unique(components[order], return_index=True)
+            self.cache.setdefault('subgraphs_by_label', dict())
+            for label, rows in zip(labels, np.split(order, starts[1:])):
+                if label not in self.cache['subgraphs_by_label']:
+                    self.cache['subgraphs_by_label'][label] = Graph(*[self.members[i] for i in rows])
+            self.cache['subgraphs'] = set(self.cache['subgraphs_by_label'].values())
 
         return self.cache['subgraphs']
 
     def subgraph(self, cluster: 'Cluster') -> 'Graph':
         """ Returns the subgraph to which the cluster belongs. """
-        for subgraph in self.subgraphs:
-            if cluster in subgraph.edges:
-                return subgraph
-        else:
+        if cluster not in self.index:
             raise ValueError(f'cluster {cluster.name} not found in and subgraph.')
+        return self._component(int(self.components[self.index[cluster]]))
+
+    def json(self):
+        """ This is used for writing the graph to disk, along with its edges if they were built. """
+        data = {
+            'clusters': [cluster.name for cluster in self.members],
+            'adjacency': None if self.adjacency is None else self.adjacency._asdict(),
+            'walkable': None,
+            'components': None,
+        }
+        if self.adjacency is not None:
+            data['walkable'] = self.walkable
+            data['components'] = self.components
+        return data
+
+    @staticmethod
+    def from_json(manifold: 'Manifold', data) -> 'Graph':
+        """ Restores a graph, without computing any distances. """
+        graph = Graph(*[manifold.select(name) for name in data['clusters']])
+        if data['adjacency'] is not None:
+            graph.adjacency = Adjacency(**data['adjacency'])
+            graph.cache['walkable'] = data['walkable']
+            graph.cache['walkable_clusters'] = {cluster for cluster, w in zip(graph.members, data['walkable']) if w}
+            graph.cache['subsumed_clusters'] = {cluster for cluster, w in zip(graph.members, data['walkable']) if not w}
+            graph.cache['components'] = data['components']
+        return graph
+
+    def dump(self, fp: Union[BinaryIO, IO[bytes]]) -> None:
+        pickle.dump(self.json(), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        return
+
+    @staticmethod
+    def load(fp: Union[BinaryIO, IO[bytes]], manifold: 'Manifold') -> 'Graph':
+        return Graph.from_json(manifold, pickle.load(fp))
 
     def clear_cache(self) -> None:
         """ Clears the cache of the graph. """
         # Clear all cached values and edges.
         self.cache.clear()
-        self.edges = {cluster: None for cluster in self.edges}
+        self.adjacency = None
         return
 
-    # noinspection DuplicatedCode
+    def _neighbor_positions(self, cluster: Cluster, choice: str) -> np.ndarray:
+        """ Positions, in the adjacency arrays, of the edges from cluster to the chosen neighbors. """
+        row = self._row(cluster)
+        positions = np.arange(row.start, row.stop)
+        if choice == 'all':
+            return positions
+        elif choice == 'walkable':
+            if not self.walkable[self.index[cluster]]:
+                raise KeyError(f'{cluster} is not a walkable cluster')
+            return positions[self.walkable[self.adjacency.indices[row]]]
+        elif choice == 'subsumed':
+            return positions[~self.walkable[self.adjacency.indices[row]]]
+        else:
+            raise ValueError(f'choice must be one of: '
+                             f'\'all\', '
+                             f'\'walkable\', or '
+                             f'\'subsumed\'. '
+                             f'Got: {choice}')
+
+    def edge_set(self, cluster: Cluster, *, choice: str = 'all') -> Set[Edge]:
+        """ return the set of edges from a given cluster.
+
+        :param cluster: source cluster
+        :param choice: 'all' for all neighbors,
+                       'walkable' for only those that are not subsumed, with transition probabilities,
+                       'subsumed' for only those that are subsumed.
+        :return: set of relevant edges
+        """
+        positions = self._neighbor_positions(cluster, choice)
+        neighbors = [self.members[j] for j in self.adjacency.indices[positions]]
+        distances = self.adjacency.distances[positions]
+        if choice == 'walkable':
+            probabilities = self.adjacency.probabilities[positions]
+            return {Edge(n, float(d), float(p)) for n, d, p in zip(neighbors, distances, probabilities)}
+        else:
+            return {Edge(n, float(d), None) for n, d in zip(neighbors, distances)}
+
     def neighbors(
             self,
             cluster: Cluster,
@@ -850,23 +1116,9 @@ class Graph:
                        'subsumed' for only those that are subsumed.
         :return: list of relevant neighbors
         """
-        if self.edges[cluster] is None:
-            self.build_edges()
-
-        if choice == 'all':
-            return [edge.neighbor for edge in self.edges[cluster]]
-        elif choice == 'walkable':
-            return [edge.neighbor for edge in self.walkable_edges[cluster]]
-        elif choice == 'subsumed':
-            return [edge.neighbor for edge in self.subsumed_edges[cluster]]
-        else:
-            raise ValueError(f'choice must be one of: '
-                             f'\'all\', '
-                             f'\'walkable\', or '
-                             f'\'subsumed\'. '
-                             f'Got: {choice}')
+        positions = self._neighbor_positions(cluster, choice)
+        return [self.members[j] for j in self.adjacency.indices[positions]]
 
-    # noinspection DuplicatedCode
     def distances(
             self,
             cluster: Cluster,
@@ -881,21 +1133,8 @@ class Graph:
                        'subsumed' for only those that are subsumed.
         :return: list of relevant distances to neighbors
         """
-        if self.edges[cluster] is None:
-            self.build_edges()
-
-        if choice == 'all':
-            return [edge.distance for edge in self.edges[cluster]]
-        elif choice == 'walkable':
-            return [edge.distance for edge in self.walkable_edges[cluster]]
-        elif choice == 'subsumed':
-            return [edge.distance for edge in self.subsumed_edges[cluster]]
-        else:
-            raise ValueError(f'choice must be one of: '
-                             f'\'all\', '
-                             f'\'walkable\', or '
-                             f'\'subsumed\'. '
-                             f'Got: {choice}')
+        positions = self._neighbor_positions(cluster, choice)
+        return list(map(float, self.adjacency.distances[positions]))
 
     def probabilities(
             self,
@@ -907,27 +1146,60 @@ class Graph:
         :param cluster: source cluster.
         :return: list of transition probabilities to walkable neighbors.
         """
-        if self.edges[cluster] is None:
+        if self.adjacency is None:
             self.build_edges()
 
         if cluster in self.subsumed_clusters:
             raise ValueError(f"cannot have transition probabilities for subsumed clusters")
 
-        probabilities = [edge.probability for edge in self.walkable_edges[cluster]]
-        if any((p is None for p in probabilities)):
-            self.recompute_transition_probabilities()
-            probabilities = [edge.probability for edge in self.walkable_edges[cluster]]
-        return probabilities
+        positions = self._neighbor_positions(cluster, 'walkable')
+        return list(map(float, self.adjacency.probabilities[positions]))
+
+    @property
+    def walk_table(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Tables for sampling transitions of random walks, for all clusters at once.
+
+        The first is, for each edge, the row of its source plus the cumulative transition probability within that row.
+        A walker in row r, drawing u from [0, 1), moves along the first edge whose entry exceeds r + u.
+        The second is, for each row, the position of its last edge with a non-zero probability, or -1 if it has none.
+        """
+        if 'walk_table' not in self.cache:
+            indptr, _, _, probabilities = self.adjacency
+            counts = np.diff(indptr)
+            rows = np.repeat(np.arange(self.cardinality), counts)
+
+            cumulative = np.cumsum(probabilities)
+            offsets = np.concatenate([[0.], cumulative])[indptr[:-1]]
+            cumulative -= np.repeat(offsets, counts)
+            totals = np.ones(shape=(self.cardinality,), dtype=np.float64)
+            nonempty = counts > 0
+            totals[nonempty] = cumulative[indptr[1:][nonempty] - 1]
+            totals[totals <= 0.] = 1.
+
+            last = np.full(shape=(self.cardinality,), fill_value=-1, dtype=np.int64)
+            positive = np.flatnonzero(probabilities > 0.)
+            np.maximum.at(last, rows[positive], positive)
+
+            self.cache['walk_table'] = rows + cumulative / totals[rows], last
+        return self.cache['walk_table']
 
     def random_walks(
             self,
             starts: Union[str, List[str], Cluster, List[Cluster]],
             steps: int,
+            *,
+            seed: int = None,
+            workers: int = None,
     ) -> Dict[Cluster, int]:
         """ Performs random walks, counting visitations of each cluster.
 
+        All walkers take each step together, using the tables from walk_table.
+
         :param starts: Clusters at which to start the random walks.
         :param steps: number of steps to take per walk.
+        :param seed: Optional. Seed for the random walks. If not given, one is drawn from np.random.
+        :param workers: Optional. Number of processes among which to divide the walkers.
+                        Each process draws from an independent stream spawned from the seed.
         :return: a dictionary of cluster to visit count.
         """
         if self.cardinality < 2:
@@ -938,120 +1210,294 @@ class Graph:
         if type(starts) is list and type(starts[0]) is str:
             starts = [self.manifold.select(cluster) for cluster in starts]
 
-        if any((edges is None for edges in self.edges.values())):
+        if self.adjacency is None:
             self.build_edges()
 
         if any((cluster not in self.walkable_clusters for cluster in starts)):
             raise ValueError(f'random walks may only be started at clusters '
                              f'that are not subsumed by other clusters.')
 
-        counts = {cluster: 0 for cluster in self.clusters}
-        counts.update({cluster: 1 for cluster in starts})
+        if seed is None:
+            seed = int(np.random.randint(2 ** 31))
+
+        counts = np.zeros(shape=(self.cardinality,), dtype=np.int64)
+        starts = np.asarray([self.index[cluster] for cluster in starts], dtype=np.int64)
+        counts[starts] = 1
 
         # initialize walk locations.
         # only walk from clusters that have some walkable neighbors
-        walks = [cluster for cluster in starts if len(self.walkable_edges[cluster]) > 0]
+        cumulative, last = self.walk_table
+        walks = starts[last[starts] >= 0]
+        if workers is None or workers < 2:
+            counts += _random_walks(self.adjacency.indices, cumulative, last, walks, steps, seed)
+        else:
+            chunks = np.array_split(walks, workers)
+            seeds = np.random.SeedSequence(seed).spawn(workers)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(_random_walks, self.adjacency.indices, cumulative, last, chunk, steps, s)
+                    for chunk, s in zip(chunks, seeds)
+                ]
+                for future in futures:
+                    counts += future.result()
+
+        counts = self._credit_subsumed(counts)
+        return {cluster: int(count) for cluster, count in zip(self.members, counts)}
+
+    def _credit_subsumed(self, values: np.ndarray) -> np.ndarray:
+        """ Credits subsumed clusters with the values of the walkable clusters that subsume them. """
+        indptr, indices = self.adjacency.indptr, self.adjacency.indices
+        sources = np.repeat(np.arange(self.cardinality), np.diff(indptr))
+        mask = self.walkable[sources] & ~self.walkable[indices]
+        np.add.at(values, indices[mask], values[sources[mask]])
+        return values
+
+    @property
+    def transition_matrix(self) -> sparse.csr_matrix:
+        """ Sparse matrix of transition probabilities, by row, among walkable clusters.
+
+        Rows of subsumed clusters, and of walkable clusters without walkable neighbors, are empty.
+        """
+        if 'transition_matrix' not in self.cache:
+            if self.adjacency is None:
+                self.build_edges()
+            indptr, indices, _, probabilities = self.adjacency
+            self.cache['transition_matrix'] = sparse.csr_matrix(
+                (probabilities, indices, indptr),
+                shape=(self.cardinality, self.cardinality),
+            )
+        return self.cache['transition_matrix']
+
+    def _lazy_transitions(self) -> sparse.csr_matrix:
+        # A lazy walk stays put with probability 1/2, so periodic components still converge.
+        # Walkable clusters without walkable neighbors always stay put.
+        matrix = self.transition_matrix
+        stay = np.where(np.asarray(matrix.sum(axis=1)).ravel() > 0., 0.5, 1.)
+        return (matrix * 0.5 + sparse.diags(stay * self.walkable)).tocsr()
+
+    def stationary_distribution(
+            self,
+            *,
+            tolerance: float = 1e-8,
+            max_iterations: int = 1_000,
+    ) -> Dict[Cluster, float]:
+        """ Computes the stationary distribution of random walks among walkable clusters, by power iteration.
+
+        The distribution is computed for each connected component separately, so it sums to 1 within each component.
+        Iteration starts from the total inverse-distance weight of the walkable edges of each cluster.
+        That is already stationary for probabilities from recompute_transition_probabilities,
+        so iteration only has to correct for rounding, or for probabilities set otherwise.
+        Subsumed clusters are credited as in random_walks.
+
+        :param tolerance: iteration stops when the L1 change in the distribution falls below this.
+        :param max_iterations: maximum number of iterations.
+        :return: a dictionary of cluster to stationary probability.
+        """
+        if self.adjacency is None:
+            self.build_edges()
+
+        labels = self.components[self.walkable]
+
+        indptr, indices, distances, _ = self.adjacency
+        sources = np.repeat(np.arange(self.cardinality), np.diff(indptr))
+        mask = self.walkable[sources] & self.walkable[indices]
+        weights = np.bincount(sources[mask], weights=1. / distances[mask], minlength=self.cardinality)[self.walkable]
+        weights[weights <= 0.] = 1.
+
+        distribution = np.zeros(shape=(self.cardinality,), dtype=np.float64)
+        distribution[self.walkable] = weights / np.bincount(labels, weights=weights)[labels]
+
+        transitions = self._lazy_transitions().T.tocsr()
+        for i in range(max_iterations):
+            update = transitions @ distribution
+            change = float(np.sum(np.abs(update - distribution)))
+            distribution = update
+            if change < tolerance:
+                logging.debug(f'stationary distribution converged after {i + 1} iterations')
+                break
+        else:
+            logging.info(f'stationary distribution did not converge in {max_iterations} iterations. '
+                         f'Last change: {change:.2e}')
+
+        distribution = self._credit_subsumed(distribution)
+        return {cluster: float(p) for cluster, p in zip(self.members, distribution)}
+
+    def expected_visits(
+            self,
+            starts: Union[str, List[str], Cluster, List[Cluster]],
+            steps: int,
+    ) -> Dict[Cluster, float]:
+        """ Computes the expected visit counts of random_walks, without simulating them.
+
+        :param starts: Clusters at which to start the random walks.
+        :param steps: number of steps to take per walk.
+        :return: a dictionary of cluster to expected visit count.
+        """
+        if self.cardinality < 2:
+            return {cluster: 1. for cluster in self.clusters}
+
+        if type(starts) in {Cluster, str}:
+            starts = [starts]
+        if type(starts) is list and type(starts[0]) is str:
+            starts = [self.manifold.select(cluster) for cluster in starts]
+
+        if self.adjacency is None:
+            self.build_edges()
+
+        if any((cluster not in self.walkable_clusters for cluster in starts)):
+            raise ValueError(f'random walks may only be started at clusters '
+                             f'that are not subsumed by other clusters.')
+
+        counts = np.zeros(shape=(self.cardinality,), dtype=np.float64)
+        starts = np.asarray([self.index[cluster] for cluster in starts], dtype=np.int64)
+        counts[starts] = 1.
+
+        # only walk from clusters that have some walkable neighbors
+        _, last = self.walk_table
+        walks = np.bincount(starts[last[starts] >= 0], minlength=self.cardinality).astype(np.float64)
+        transitions = self.transition_matrix.T.tocsr()
         for _ in range(steps):
-            # update walk locations
-            walks = [
-                np.random.choice(
-                    a=self.neighbors(cluster, choice='walkable'),
-                    p=self.probabilities(cluster),
-                ) for cluster in walks
-            ]
-            # increment visit counts
-            for cluster in walks:
-                counts[cluster] += 1
-
-        for cluster in self.walkable_clusters:
-            counts.update({
-                neighbor: counts[cluster] + counts[neighbor]
-                for neighbor in self.neighbors(cluster, choice='subsumed')
-            })
-        return counts
+            walks = transitions @ walks
+            counts += walks
 
-    def traverse(self, start: Cluster) -> Set[Cluster]:
-        """ Graph traversal starting at start. """
-        if any((edges is None for edges in self.edges.values())):
+        counts = self._credit_subsumed(counts)
+        return {cluster: float(count) for cluster, count in zip(self.members, counts)}
+
+    @property
+    def walkable_adjacency(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ The indptr and indices arrays, in compressed-sparse-row form, of only the edges among walkable clusters. """
+        if 'walkable_adjacency' not in self.cache:
+            if self.adjacency is None:
+                self.build_edges()
+            indptr, indices = self.adjacency.indptr, self.adjacency.indices
+            sources = np.repeat(np.arange(self.cardinality), np.diff(indptr))
+            mask = self.walkable[sources] & self.walkable[indices]
+            walkable_indptr = np.zeros(shape=(self.cardinality + 1,), dtype=np.int64)
+            np.cumsum(np.bincount(sources[mask], minlength=self.cardinality), out=walkable_indptr[1:])
+            self.cache['walkable_adjacency'] = walkable_indptr, indices[mask]
+        return self.cache['walkable_adjacency']
+
+    def hops(
+            self,
+            starts: Union[Cluster, List[Cluster]],
+            max_hops: int = None,
+    ) -> np.ndarray:
+        """ Breadth-first traversal from one or more walkable clusters at once, one frontier at a time.
+
+        Subsumed clusters take the smallest number of hops among the walkable clusters that subsume them.
+
+        :param starts: Clusters at which to start.
+        :param max_hops: Optional. Number of hops after which to stop.
+        :return: array, by row, of the number of hops from the nearest start, or -1 for clusters not reached.
+        """
+        if self.adjacency is None:
             self.build_edges()
 
-        if start in self.subsumed_clusters:
+        if type(starts) is Cluster:
+            starts = [starts]
+        if any((cluster in self.subsumed_clusters for cluster in starts)):
             raise ValueError(f'traversal may not start from subsumed clusters.')
 
-        logging.debug(f'starting traversal from {start}')
-        visited: Set[Cluster] = set()
-        frontier: Set[Cluster] = {start}
-        # visit all reachable walkable clusters
-        while frontier:
-            visited.update(frontier)
-            frontier = {
-                neighbor for cluster in frontier
-                for neighbor in self.neighbors(cluster, choice='walkable')
-                if neighbor not in visited
-            }
+        logging.debug(f'starting traversal from {len(starts)} clusters')
+        indptr, indices = self.walkable_adjacency
+        hops = np.full(shape=(self.cardinality,), fill_value=-1, dtype=np.int64)
+        frontier = np.unique(np.asarray([self.index[cluster] for cluster in starts], dtype=np.int64))
+        hop = 0
+        while len(frontier) > 0:
+            hops[frontier] = hop
+            if max_hops is not None and hop >= max_hops:
+                break
+            hop += 1
+
+            # gather the neighbors of every cluster in the frontier at once
+            _, positions = _segments(indptr, frontier)
+            neighbors = indices[positions]
+            frontier = np.unique(neighbors[hops[neighbors] < 0])
 
         # include the clusters subsumed by visited walkable clusters
-        visited.update({
-            edge.neighbor for cluster in visited
-            for edge in self.subsumed_edges[cluster]
-        })
-        return visited
+        indptr, indices = self.adjacency.indptr, self.adjacency.indices
+        sources = np.repeat(np.arange(self.cardinality), np.diff(indptr))
+        mask = (hops[sources] >= 0) & self.walkable[sources] & ~self.walkable[indices]
+        subsumed = np.full(shape=(self.cardinality,), fill_value=np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(subsumed, indices[mask], hops[sources[mask]])
+        reached = subsumed < np.iinfo(np.int64).max
+        hops[reached] = subsumed[reached]
+        return hops
+
+    def eccentricity(self, cluster: Cluster) -> int:
+        """ The largest number of hops from the cluster to any walkable cluster reachable from it. """
+        return int(np.max(self.hops(cluster)[self.walkable]))
+
+    def _visited(self, start: Cluster) -> Set[Cluster]:
+        hops = self.hops(start)
+        return {self.members[i] for i in np.flatnonzero(hops >= 0)}
+
+    def traverse(self, start: Cluster) -> Set[Cluster]:
+        """ Graph traversal starting at start. """
+        return self._visited(start)
 
     def bft(self, start: Cluster) -> Set[Cluster]:
         """ Breadth-First Traversal starting at start. """
-        if any((edges is None for edges in self.edges.values())):
-            self.build_edges()
+        return self._visited(start)
 
-        if start in self.subsumed_clusters:
-            raise ValueError(f'traversal may not start from a subsumed cluster.')
+    def dft(self, start: Cluster) -> Set[Cluster]:
+        """ Depth-First Traversal starting at start.
 
-        logging.debug(f'starting breadth-first-traversal from {start}')
-        visited = set()
-        queue = deque([start])
-        while queue:
-            cluster = queue.popleft()
-            if cluster not in visited:
-                visited.add(cluster)
-                queue.extend((
-                    neighbor
-                    for neighbor in self.neighbors(cluster, choice='walkable')
-                    if neighbor not in visited
-                ))
-
-        subsumed_visits = {
-            neighbor for cluster in visited
-            for neighbor in self.neighbors(cluster, choice='subsumed')
-        }
-        visited.update(subsumed_visits)
-        return visited
+        The set of visited clusters does not depend on the order of traversal,
+        so this visits clusters a frontier at a time, as in bft.
+        """
+        return self._visited(start)
 
-    def dft(self, start: Cluster) -> Set[Cluster]:
-        """ Depth-First Traversal starting at start. """
-        if any((edges is None for edges in self.edges.values())):
-            self.build_edges()
 
-        if start in self.subsumed_clusters:
-            raise ValueError(f'traversal may not start from a subsumed cluster.')
+class Layers(Sequence):
+    """ A lazy view of the Graph-stack, with one layer for every depth of the Cluster-tree.
 
-        logging.debug(f'starting depth-first-traversal from {start}')
-        visited = set()
-        stack: List[Cluster] = [start]
-        while stack:
-            cluster = stack.pop()
-            if cluster not in visited:
-                visited.add(cluster)
-                stack.extend((
-                    neighbor
-                    for neighbor in self.neighbors(cluster, choice='walkable')
-                    if neighbor not in visited
-                ))
-
-        subsumed_visits = {
-            neighbor for cluster in visited
-            for neighbor in self.neighbors(cluster, choice='subsumed')
-        }
-        visited.update(subsumed_visits)
-        return visited
+    The layer at a depth holds the clusters at that depth, and the childless clusters above it.
+    Clusters are collected from the tree, and a Graph is built, only when a layer is requested.
+    Graphs are kept only as long as something else holds on to them.
+    """
+    def __init__(self, manifold: 'Manifold', depth: int = None):
+        """
+        :param manifold: manifold whose Cluster-tree to view.
+        :param depth: Optional. Depth of the deepest layer. Defaults to the depth of the deepest cluster in the tree.
+        """
+        self.manifold: 'Manifold' = manifold
+        if depth is None:
+            depth, clusters = 0, [manifold.root]
+            while clusters:
+                cluster = clusters.pop()
+                depth = max(depth, cluster.depth)
+                clusters.extend(cluster.children or [])
+        self.depth: int = depth
+        self.graphs: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    def __len__(self) -> int:
+        return self.depth + 1
+
+    def _depth(self, depth: int) -> int:
+        if not -len(self) <= depth < len(self):
+            raise IndexError(f'layer index out of range. Got {depth}, with {len(self)} layers')
+        return depth % len(self)
+
+    def clusters(self, depth: int) -> List[Cluster]:
+        """ Returns the clusters in the layer at depth, without building a Graph. """
+        depth = self._depth(depth)
+        clusters: List[Cluster] = [self.manifold.root]
+        for _ in range(depth):
+            childless = [cluster for cluster in clusters if not cluster.children]
+            with_child = [cluster for cluster in clusters if cluster.children]
+            clusters = childless + [child for cluster in with_child for child in cluster.children]
+        return clusters
+
+    def __getitem__(self, depth: Union[int, slice]) -> Union[Graph, List[Graph]]:
+        if isinstance(depth, slice):
+            return [self[d] for d in range(len(self))[depth]]
+        depth = self._depth(depth)
+        graph = self.graphs.get(depth)
+        if graph is None:
+            graph = Graph(*self.clusters(depth))
+            self.graphs[depth] = graph
+        return graph
 
 
 class Manifold:
@@ -1089,9 +1535,34 @@ class Manifold:
         else:
             raise ValueError(f"Invalid argument to argpoints. {argpoints}")
 
+        # Clusters, indexed by their ids. Ids are handed out by name, so a rebuilt cluster keeps its id.
+        self.clusters: List[Cluster] = list()
+        self.cluster_ids: Dict[str, int] = dict()
+        self.lock: threading.RLock = threading.RLock()
+
+        # Distances between medoids of pairs of clusters, keyed by the pair of cluster ids.
+        # Entries are evicted in least-recently-used order beyond distance_cache_size.
+        self.distance_cache: OrderedDict = OrderedDict()
+        self.distance_cache_size: int = DISTANCE_CACHE_SIZE
+        # Keys in distance_cache of the pairs that include each cluster id, to evict the entries of one cluster.
+        self.distance_keys: Dict[int, Set[int]] = dict()
+
         self.root: Cluster = Cluster(self, self.argpoints, '')
-        self.layers: List[Graph] = [Graph(self.root)]
+        self.layers: Layers = Layers(self, depth=0)
         self.graph: Graph = Graph(self.root)
+        # Other graphs, by name, to be saved and loaded along with the manifold.
+        self.graphs: Dict[str, Graph] = dict()
+
+        # ClusterCriteria to use for partitioning clusters on demand after a lazy build.
+        self.lazy_criteria: Union[None, Tuple] = None
+
+        # Indices of points that were deleted but may still be held by clusters until the next compaction.
+        self.tombstones: Set[int] = set()
+        # Indices of points that compaction removed. extend leaves them out unless they are asked for by index.
+        self.removed: Set[int] = set()
+
+        # Whether the manifold was frozen for concurrent searches, see freeze.
+        self.frozen: bool = False
 
         self.cache: Dict[str, Any] = dict()
         self.cache.update(**kwargs)
@@ -1118,12 +1589,89 @@ class Manifold:
         return self.cache['repr']
 
     def clear_cache(self):
+        self._mutable('clear the cache of')
         self.cache = dict()
         return
 
     @property
     def depth(self) -> int:
-        return len(self.layers) - 1
+        return self.layers.depth
+
+    def _mutable(self, action: str) -> None:
+        if self.frozen:
+            raise ValueError(f'Cannot {action} a frozen manifold.')
+        return
+
+    def _mean_leaf_radius(self) -> float:
+        if 'leaves' not in self.cache:
+            self.cache['leaves'] = float(np.mean([leaf.radius for leaf in self.layers.clusters(-1)]))
+        return self.cache['leaves']
+
+    def _register(self, cluster: Cluster) -> int:
+        # clusters are created from several threads during partitioning.
+        with self.lock:
+            cluster_id = self.cluster_ids.setdefault(cluster.name, len(self.cluster_ids))
+            if cluster_id == len(self.clusters):
+                self.clusters.append(cluster)
+            else:
+                # a rebuilt cluster may have a different medoid.
+                self.clusters[cluster_id] = cluster
+                self._evict_distances(cluster_id)
+        return cluster_id
+
+    def _evict_distances(self, cluster_id: int) -> None:
+        """ Drops the cached medoid distances of every pair that includes the cluster with the given id. """
+        with self.lock:
+            for key in self.distance_keys.pop(cluster_id, set()):
+                self.distance_cache.pop(key, None)
+                other = key >> 32 if key & 0xFFFFFFFF == cluster_id else key & 0xFFFFFFFF
+                if other in self.distance_keys:
+                    self.distance_keys[other].discard(key)
+        return
+
+    def medoid_distances(self, left: List[Cluster], right: List[Cluster]) -> np.ndarray:
+        """ Calculates the distances between the medoids of corresponding clusters in left and right.
+
+        Distances are looked up in, and added to, distance_cache.
+
+        :param left: list of clusters.
+        :param right: list of clusters, of the same length as left.
+        :return: vector of distances.
+        """
+        if len(left) != len(right):
+            raise ValueError(f'left and right must have the same number of clusters. Got {len(left)} and {len(right)}')
+
+        left_ids = np.asarray([cluster.id for cluster in left], dtype=np.int64)
+        right_ids = np.asarray([cluster.id for cluster in right], dtype=np.int64)
+        keys: List[int] = ((np.minimum(left_ids, right_ids) << 32) | np.maximum(left_ids, right_ids)).tolist()
+
+        distances = np.empty(shape=(len(keys),), dtype=np.float64)
+        with self.lock:
+            cached = [self.distance_cache.get(key) for key in keys]
+            [self.distance_cache.move_to_end(key) for key, d in zip(keys, cached) if d is not None]
+        missing = np.asarray([d is None for d in cached], dtype=bool).reshape(-1)
+        distances[~missing] = [d for d in cached if d is not None]
+
+        missing = np.flatnonzero(missing)
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+            distances[batch] = self.paired_distance(
+                [left[j].argmedoid for j in batch],
+                [right[j].argmedoid for j in batch],
+            )
+
+        if self.distance_cache_size > 0 and len(missing) > 0:
+            with self.lock:
+                for j in missing[-self.distance_cache_size:]:
+                    self.distance_cache[keys[j]] = float(distances[j])
+                    self.distance_keys.setdefault(int(left_ids[j]), set()).add(keys[j])
+                    self.distance_keys.setdefault(int(right_ids[j]), set()).add(keys[j])
+                while len(self.distance_cache) > self.distance_cache_size:
+                    key, _ = self.distance_cache.popitem(last=False)
+                    for cluster_id in (key >> 32, key & 0xFFFFFFFF):
+                        if cluster_id in self.distance_keys:
+                            self.distance_keys[cluster_id].discard(key)
+        return distances
 
     def distance(self, x1: Union[List[int], Data], x2: Union[List[int], Data]) -> np.ndarray:
         """ Calculates the pairwise distances between all points in x1 and x2.
@@ -1147,8 +1695,55 @@ class Manifold:
 
         return cdist(x1, x2, metric=self.metric)
 
-    def build(self, *criteria) -> 'Manifold':
-        """ Rebuilds the Cluster-tree and the Graph-stack. """
+    def paired_distance(
+            self,
+            x1: Union[List[int], Data],
+            x2: Union[List[int], Data],
+            metric: Metric = None,
+    ) -> np.ndarray:
+        """ Calculates the distances between corresponding points in x1 and x2.
+
+        Common metrics are computed with vectorized numpy operations.
+        Any other metric falls back to one call to cdist per pair.
+
+        :param x1: a list of indices, or a 2D matrix of data points
+        :param x2: a list of indices, or a 2D matrix of data points, of the same length as x1
+        :param metric: Optional. The metric to use instead of the one given to Manifold.
+        :return: vector of distances.
+        """
+        metric = self.metric if metric is None else metric
+        x1, x2 = np.asarray(x1), np.asarray(x2)
+        if len(x1.shape) < 2:
+            x1 = self.data[x1 if x1.ndim == 1 else np.expand_dims(x1, 0)]
+        if len(x2.shape) < 2:
+            x2 = self.data[x2 if x2.ndim == 1 else np.expand_dims(x2, 0)]
+        if x1.shape[0] != x2.shape[0]:
+            raise ValueError(f'x1 and x2 must have the same number of points. Got {x1.shape[0]} and {x2.shape[0]}')
+
+        x1, x2 = np.asarray(x1, dtype=np.float64), np.asarray(x2, dtype=np.float64)
+        if metric in {'euclidean', 'sqeuclidean'}:
+            difference = x1 - x2
+            distances = np.einsum('ij,ij->i', difference, difference)
+            return np.sqrt(distances) if metric == 'euclidean' else distances
+        elif metric == 'cityblock':
+            return np.sum(np.abs(x1 - x2), axis=1)
+        elif metric == 'chebyshev':
+            return np.max(np.abs(x1 - x2), axis=1, initial=0.)
+        elif metric == 'cosine':
+            norms = np.linalg.norm(x1, axis=1) * np.linalg.norm(x2, axis=1)
+            return 1. - np.einsum('ij,ij->i', x1, x2) / norms
+        else:
+            return np.asarray([cdist([a], [b], metric=metric)[0][0] for a, b in zip(x1, x2)], dtype=np.float64)
+
+    def build(self, *criteria, extend: bool = False, lazy_depth: int = None) -> 'Manifold':
+        """ Rebuilds the Cluster-tree and the Graph-stack.
+
+        :param criteria: Cluster, Selection and Graph criteria to use.
+        :param extend: Whether to add every point in data to the tree after building it.
+                       This is meant for a manifold built on a sample of the data.
+        :param lazy_depth: Optional. Build the tree only down to this depth, see build_tree.
+        """
+        self._mutable('build')
         from pyclam.criterion import ClusterCriterion, SelectionCriterion, GraphCriterion
         cluster_criteria: List[ClusterCriterion] = [
             criterion for criterion in criteria
@@ -1166,31 +1761,189 @@ class Manifold:
             if isinstance(criterion, GraphCriterion)
         ]
 
-        self.layers = [Graph(self.root)]
-        self.build_tree(*cluster_criteria)
+        self.layers = Layers(self, depth=0)
+        self.graphs = dict()
+        self.lazy_criteria = None
+        self.build_tree(*cluster_criteria, lazy_depth=lazy_depth)
+        if extend:
+            self.extend()
         if selection_criteria:
             graph = selection_criteria[0](self.root)
         else:
             warnings.warn(message="No Selection Criterion was provided. Using leaves for building graph...")
-            graph = [cluster for cluster in self.layers[-1]]
+            graph = self.layers.clusters(-1)
         self.graph = Graph(*graph)
         self.build_graph(*graph_criteria)
 
         return self
 
-    def build_tree(self, *criterion) -> 'Manifold':
-        """ Builds the Cluster-tree. """
-        while True:
-            logging.info(f'depth: {self.depth}, {self.layers[-1].cardinality} clusters')
+    def build_tree(self, *criterion, lazy_depth: int = None) -> 'Manifold':
+        """ Builds the Cluster-tree.
+
+        :param criterion: ClusterCriteria that decide whether a cluster may be partitioned.
+        :param lazy_depth: Optional. Build the tree only down to this depth.
+                           Deeper clusters are partitioned, under the same criteria,
+                           the first time a search descends into them.
+                           Until then, the layers only hold the clusters that were built up front.
+        """
+        self._mutable('build the tree of')
+        if self.lazy_criteria is not None:
+            # Finish the tree before going any deeper.
+            logging.info(f'expanding lazily built tree')
+            self._expand_all()
+            self._build_layers()
+            self.lazy_criteria = None
+
+        self.cache.pop('leaves', None)
+        while lazy_depth is None or self.depth < lazy_depth:
+            cardinality = len(self.layers.clusters(-1))
+            logging.info(f'depth: {self.depth}, {cardinality} clusters')
             clusters = self._partition_threaded(criterion)
-            if self.layers[-1].cardinality < len(clusters):
-                self.layers.append(Graph(*clusters))
+            if cardinality < len(clusters):
+                self.layers = Layers(self, depth=self.depth + 1)
             else:
                 break
+        else:
+            # searches read these without the lock, so every cluster built so far has them cached up front.
+            clusters: List[Cluster] = [self.root]
+            while clusters:
+                cluster = clusters.pop()
+                cluster._fill_cache()
+                clusters.extend(cluster.children or [])
+            self.lazy_criteria = criterion
         return self
 
+    def _expand(self, cluster: Cluster) -> None:
+        """ Partitions a cluster left unpartitioned by a lazy build. Safe to call from several threads. """
+        if self.lazy_criteria is None or cluster.children is not None:
+            return
+        with cluster.lock:
+            if cluster.children is None:
+                logging.debug(f'lazily expanding {cluster}')
+                children = cluster._split(*self.lazy_criteria)
+                # searches read these without the lock, so they are cached before the children become visible.
+                [child._fill_cache() for child in children]
+                cluster.children = children
+        return
+
+    def _expand_all(self) -> None:
+        clusters: List[Cluster] = [self.root]
+        while clusters:
+            cluster = clusters.pop()
+            self._expand(cluster)
+            clusters.extend(cluster.children or [])
+        return
+
+    def _build_layers(self) -> None:
+        """ Rebuilds the Graph-stack from the Cluster-tree. """
+        self.layers = Layers(self)
+        return
+
+    def extend(self, argpoints: Vector = None, batch_size: int = BATCH_SIZE) -> 'Manifold':
+        """ Adds points to an already built Cluster-tree.
+
+        This is the second phase of building on a sample of the data.
+        Points are streamed through the tree in batches.
+        Each point descends to a leaf by following the nearest child medoid,
+        and is added to every cluster along the way.
+        Radii grow as needed to stay valid, while medoids and local fractal dimensions are left as they are.
+
+        :param argpoints: Optional. Indices of the points to add.
+                          Defaults to all points not yet in the manifold, other than those removed by compact.
+        :param batch_size: The number of points to send down the tree at once.
+        :return: the manifold, for chaining.
+        """
+        self._mutable('extend')
+        present: np.ndarray = np.zeros(shape=(self.data.shape[0],), dtype=bool)
+        present[self.root.argpoints] = True
+
+        if argpoints is None:
+            skipped: np.ndarray = present.copy()
+            skipped[list(self.removed)] = True
+            batches = (
+                np.flatnonzero(~skipped[i:i + batch_size]) + i
+                for i in range(0, self.data.shape[0], batch_size)
+            )
+        else:
+            argpoints = np.asarray(argpoints, dtype=int)
+            if np.any(present[argpoints]):
+                raise ValueError(f'Cannot extend the manifold with points that it already contains.')
+            self.removed.difference_update(map(int, argpoints))
+            batches = (argpoints[i:i + batch_size] for i in range(0, len(argpoints), batch_size))
+
+        built: bool = self.graph.adjacency is not None
+        named: List[str] = [name for name, graph in self.graphs.items() if graph.adjacency is not None]
+        for batch in batches:
+            if len(batch) > 0:
+                logging.debug(f'extending manifold by {len(batch)} points')
+                self._extend_batch(batch)
+                if self.argpoints is not self.root.argpoints:
+                    self.argpoints.extend(map(int, batch))
+
+        # Radii may have grown, so candidates and edges must be found again.
+        [layer.clear_cache() for layer in self.layers.graphs.values()]
+        for cluster in self.clusters:
+            cluster.candidates = None
+        self.graph.clear_cache()
+        [graph.clear_cache() for graph in self.graphs.values()]
+        self.clear_cache()
+        if built:
+            self.build_graph()
+        [self.graphs[name].build_edges() for name in named]
+        return self
+
+    def _extend_batch(self, batch: np.ndarray):
+        for cluster, positions, distances in self._descend(self.data[batch], depth=-1):
+            radius = cluster.radius
+            cluster.argpoints.extend(map(int, batch[positions]))
+            cluster.cache.pop('repr', None)
+
+            farthest = int(np.argmax(distances))
+            if distances[farthest] > radius:
+                cluster.cache['radius'] = float(distances[farthest])
+                cluster.cache['argradius'] = int(batch[positions[farthest]])
+        return
+
+    def _descend(self, points: Data, depth: int, graph: Graph = None) -> Iterable[Tuple[Cluster, np.ndarray, np.ndarray]]:
+        """ Sends a batch of points down the tree, each following the nearest child medoid.
+
+        Points are grouped by the cluster they are in, so each level costs one distance computation per cluster.
+
+        :param points: 2D array of points.
+        :param depth: depth at which to stop. -1 to go down to leaves.
+        :param graph: Optional. Stop at clusters in this graph.
+        :return: For every cluster reached, from the root downward:
+                 the cluster, the positions in points of the points it received,
+                 and distances from those points to its medoid.
+        """
+        if depth == -1:
+            # searches may have expanded a lazily built tree below the depth of its layers.
+            depth = self.depth if self.lazy_criteria is None else sys.maxsize
+
+        positions: np.ndarray = np.arange(points.shape[0])
+        groups: Dict[Cluster, Tuple[np.ndarray, np.ndarray]] = {
+            self.root: (positions, self.distance([self.root.argmedoid], points)[0])
+        }
+        while groups:
+            descendants: Dict[Cluster, Tuple[np.ndarray, np.ndarray]] = dict()
+            for cluster, (positions, distances) in groups.items():
+                yield cluster, positions, distances
+                if (cluster.depth >= depth) or (not cluster.children) or (graph is not None and cluster in graph):
+                    continue
+
+                children: List[Cluster] = list(cluster.children)
+                distances = self.distance(points[positions], [child.argmedoid for child in children])
+                nearest = np.argmin(distances, axis=1)
+                for i, child in enumerate(children):
+                    chosen = nearest == i
+                    if np.any(chosen):
+                        descendants[child] = positions[chosen], distances[chosen, i]
+            groups = descendants
+        return
+
     def build_graph(self, *criteria):
         """ Builds the graph. """
+        self._mutable('build the graph of')
         depths = [cluster.depth for cluster in self.graph]
         logging.info(f'depths: ({min(depths)}, {max(depths)}), clusters: {self.graph.cardinality}')
 
@@ -1202,10 +1955,11 @@ class Manifold:
     def _partition_single(self, criterion) -> List[Cluster]:
         # TODO: Consider removing and only keeping multi-threaded version
         # filter out clusters not previously partitioned
-        new_layer: List[Cluster] = [cluster for cluster in self.layers[-1] if cluster.depth < len(self.layers) - 1]
+        layer: List[Cluster] = self.layers.clusters(-1)
+        new_layer: List[Cluster] = [cluster for cluster in layer if cluster.depth < self.depth]
 
         # get the deepest clusters. These can potentially be partitioned
-        partitionable: List[Cluster] = [cluster for cluster in self.layers[-1] if cluster.depth == len(self.layers) - 1]
+        partitionable: List[Cluster] = [cluster for cluster in layer if cluster.depth == self.depth]
         [cluster.partition(*criterion) for cluster in partitionable]
 
         # extend new_layer to contain all the new clusters
@@ -1213,16 +1967,53 @@ class Manifold:
         return new_layer
 
     def _partition_threaded(self, criterion) -> List[Cluster]:
-        new_layer: List[Cluster] = [cluster for cluster in self.layers[-1] if cluster.depth < len(self.layers) - 1]
-        partitionable: List[Cluster] = [cluster for cluster in self.layers[-1] if cluster.depth == len(self.layers) - 1]
+        layer: List[Cluster] = self.layers.clusters(-1)
+        new_layer: List[Cluster] = [cluster for cluster in layer if cluster.depth < self.depth]
+        partitionable: List[Cluster] = [cluster for cluster in layer if cluster.depth == self.depth]
+
+        # Criteria with a batch method are evaluated once for the whole layer.
+        # The rest are evaluated by each cluster as it is partitioned.
+        batched = [c for c in criterion if hasattr(c, 'batch')]
+        remaining = [c for c in criterion if not hasattr(c, 'batch')]
 
         with concurrent.futures.ThreadPoolExecutor() as executor:
-            future_to_cluster = [executor.submit(c.partition, *criterion) for c in partitionable]
+            if batched and partitionable:
+                mask = self._evaluate_batched(partitionable, batched, executor)
+                for cluster in (cluster for cluster, allowed in zip(partitionable, mask) if not allowed):
+                    logging.debug(f'{cluster} cannot be partitioned.')
+                    cluster.children = list()
+                chosen = [cluster for cluster, allowed in zip(partitionable, mask) if allowed]
+            else:
+                chosen = partitionable
+
+            future_to_cluster = [executor.submit(c.partition, *remaining) for c in chosen]
             [v.result() for v in concurrent.futures.as_completed(future_to_cluster)]
 
         [new_layer.extend(cluster.children) if cluster.children else new_layer.append(cluster) for cluster in partitionable]
         return new_layer
 
+    @staticmethod
+    def _evaluate_batched(clusters: List[Cluster], criteria, executor: concurrent.futures.Executor) -> np.ndarray:
+        """ Evaluates criteria for a whole layer and returns the mask of clusters that may be partitioned.
+
+        Radii and local fractal dimensions each cost a pass over the points, so they are only computed
+        when the batch method of some criterion takes them by name.
+        """
+        needed: Set[str] = {name for criterion in criteria for name in inspect.signature(criterion.batch).parameters}
+        properties = {
+            'depths': np.asarray([cluster.depth for cluster in clusters], dtype=np.int64),
+            'cardinalities': np.asarray([cluster.cardinality for cluster in clusters], dtype=np.int64),
+        }
+        if 'radii' in needed:
+            properties['radii'] = np.asarray(list(executor.map(lambda c: c.radius, clusters)), dtype=np.float64)
+        if 'lfds' in needed:
+            properties['lfds'] = np.asarray(list(executor.map(lambda c: c.local_fractal_dimension, clusters)), dtype=np.float64)
+
+        mask: np.ndarray = np.ones(shape=(len(clusters),), dtype=bool)
+        for criterion in criteria:
+            mask &= np.asarray(criterion.batch(clusters, **properties), dtype=bool)
+        return mask
+
     def ancestry(self, cluster: Union[str, Cluster]) -> List[Cluster]:
         """ Returns the sequence of clusters that needs to be traversed to reach the requested cluster.
 
@@ -1232,7 +2023,8 @@ class Manifold:
         if type(cluster) is Cluster:
             cluster = cluster.name
 
-        if cluster.count('0') > self.depth:
+        # a lazily built tree may already be deeper than its layers
+        if self.lazy_criteria is None and cluster.count('0') > self.depth:
             raise ValueError(f'depth of requested cluster must not be greater than depth of cluster-tree. '
                              f'Got {cluster}, max-depth: {self.depth}')
 
@@ -1260,26 +2052,183 @@ class Manifold:
         """ Returns the cluster with the given name. """
         return self.ancestry(name)[-1]
 
-    def find_points(self, point: Data, radius: Radius) -> List[Tuple[int, Radius]]:
-        """ Returns all indices of points that are within radius of point. """
-        candidates: List[int] = [p for c in self.find_clusters(point, radius, len(self.layers))
-                                 for p in c.argpoints]
+    def assign(
+            self,
+            points: Data,
+            depth: int = -1,
+            *,
+            graph: Graph = None,
+            distances: bool = False,
+    ) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """ Finds the cluster that each of a batch of points falls into.
+
+        Points descend the tree by following the nearest child medoid, all at once, level by level.
+        Unlike tree_search, this picks exactly one cluster per point.
+
+        :param points: 2D array of points. These need not be in data.
+        :param depth: depth at which to stop. -1 to go down to leaves.
+        :param graph: Optional. Stop at clusters in this graph, e.g. manifold.graph.
+        :param distances: Whether to also return the distance from each point to the medoid of its cluster.
+        :return: array of cluster ids, with manifold.clusters[id] being the cluster,
+                 and, if requested, array of distances to medoids.
+        """
+        points = np.asarray(points)
+        if points.ndim == 1:
+            points = np.expand_dims(points, axis=0)
+        if depth < -1:
+            raise ValueError(f'depth must be -1 or non-negative. Got {depth}')
+
+        ids: np.ndarray = np.zeros(shape=(points.shape[0],), dtype=np.int64)
+        medoid_distances: np.ndarray = np.zeros(shape=(points.shape[0],), dtype=np.float64)
+        for i in range(0, points.shape[0], BATCH_SIZE):
+            # deeper clusters come later and overwrite the assignments from their ancestors
+            for cluster, positions, cluster_distances in self._descend(points[i:i + BATCH_SIZE], depth, graph):
+                ids[positions + i] = cluster.id
+                medoid_distances[positions + i] = cluster_distances
+
+        return (ids, medoid_distances) if distances else ids
+
+    def scorer(self, graph: Graph = None, **kwargs):
+        """ Returns a pyclam.scoring.Scorer, to score batches of new points against this manifold without changing it.
+
+        :param graph: Optional. Graph whose clusters to score. Defaults to manifold.graph.
+        :param kwargs: see pyclam.scoring.Scorer.
+        """
+        from pyclam.scoring import Scorer
+        return Scorer(self, graph, **kwargs)
+
+    def find_points(
+            self,
+            point: Data,
+            radius: Radius,
+            *,
+            max_distances: int = None,
+            max_leaves: int = None,
+            depth: int = None,
+    ) -> List[Tuple[int, Radius]]:
+        """ Returns all indices of points that are within radius of point.
+
+        With any of the budgets, the search is approximate, see _best_first.
+
+        :param point: the query point.
+        :param radius: the search radius.
+        :param max_distances: Optional. Number of distance evaluations after which to stop.
+        :param max_leaves: Optional. Number of clusters whose points to scan before stopping.
+        :param depth: Optional. Depth at which to scan clusters instead of descending further.
+        :return: list of indices of hits and distances to them, nearest first.
+        """
+        if any((budget is not None for budget in (max_distances, max_leaves, depth))):
+            results = self._best_first(point, radius=radius, max_distances=max_distances, max_leaves=max_leaves, depth=depth)
+            return sorted(results.items(), key=itemgetter(1))
+
+        plan = self.plan(point, radius)
+        logging.debug(f'searching by {plan.strategy} at depth {plan.depth}, '
+                      f'expecting {plan.candidates:.0f} candidates, costs: {plan.costs}')
+        if plan.strategy == 'linear':
+            candidates = np.asarray(self.root.argpoints, dtype=np.int64)
+            if self.tombstones:
+                candidates = candidates[~np.isin(candidates, list(self.tombstones))]
+        else:
+            clusters = plan.clusters
+            if plan.strategy == 'tree':
+                clusters = [r for c in clusters for r in (c.tree_search(point, radius, -1) if c.children else [c])]
+            candidates: List[int] = [p for c in clusters for p in c.argpoints if p not in self.tombstones]
+
         results: Dict[int, Radius] = dict()
         point = np.expand_dims(point, axis=0)
         for i in range(0, len(candidates), BATCH_SIZE):
             batch = candidates[i:i + BATCH_SIZE]
             distances = self.distance(point, batch)[0]
-            results.update({p: d for p, d in zip(batch, distances) if d <= radius})
+            results.update({int(p): d for p, d in zip(batch, distances) if d <= radius})
         return sorted([(p, d) for p, d in results.items()], key=itemgetter(1))
 
+    def plan(self, point: Data, radius: Radius) -> Plan:
+        """ Chooses how find_points should search for the points within radius of point.
+
+        The tree is probed down to the deepest depth at which at most PLAN_WIDTH clusters overlap the query.
+        Below that, the number of candidates left by a full tree search is estimated from each overlapping
+        cluster's cardinality, radius and local fractal dimension, as the points within radius + twice the
+        mean radius of leaves of its medoid. Costs, in distance evaluations, are then estimated for:
+            'tree': searching the tree down to leaves,
+            'shallow': scanning the points of the clusters at the probed depth,
+            'linear': scanning every point, in blocks.
+
+        :return: Plan with the cheapest strategy, the probed depth and the clusters overlapping the query there,
+                 the estimated number of candidates for that strategy and the estimated cost of every strategy.
+        """
+        leaf_radius = self._mean_leaf_radius()
+
+        clusters: List[Cluster] = [self.root]
+        while True:
+            [self._expand(cluster) for cluster in clusters if cluster.children is None]
+            children = [child for cluster in clusters for child in (cluster.children or [cluster])]
+            if len(children) == len(clusters):
+                break
+            child_distances = self.distance(np.expand_dims(point, axis=0), [child.argmedoid for child in children])[0]
+            overlapping = [i for i, (child, d) in enumerate(zip(children, child_distances)) if d <= radius + child.radius]
+            if len(overlapping) > PLAN_WIDTH:
+                break
+            clusters = [children[i] for i in overlapping]
+            if not clusters:
+                break
+
+        depth: int = max((cluster.depth for cluster in clusters), default=0)
+        population: int = self.root.cardinality - len(self.tombstones)
+        shallow: int = sum(cluster.cardinality for cluster in clusters)
+        tree: float = 0.
+        for cluster in clusters:
+            if cluster.children and cluster.radius > 0:
+                fraction = min(1., ((radius + 2 * leaf_radius) / cluster.radius) ** cluster.local_fractal_dimension)
+                tree += cluster.cardinality * fraction
+            else:
+                tree += cluster.cardinality
+        tree = min(tree, shallow)
+        # every cluster with children is searched on its own, one batch of distances per depth.
+        searches: int = sum(1 for cluster in clusters if cluster.children)
+
+        candidates = {'tree': tree, 'shallow': float(shallow), 'linear': float(population)}
+        costs = {
+            'tree': tree + PLAN_CLUSTER_COST * searches * max(self.depth - depth, 1),
+            'shallow': float(shallow),
+            'linear': PLAN_LINEAR_COST * population,
+        }
+        strategy = min(costs, key=costs.get)
+        return Plan(strategy, depth, clusters, candidates[strategy], costs)
+
     def find_clusters(self, point: Data, radius: Radius, depth: int) -> Dict['Cluster', Radius]:
         """ Returns all clusters that contain points within radius of point at depth. """
-        return {r: d for c in self.layers[0] for r, d in c.tree_search(point, radius, depth).items()}
+        return self.root.tree_search(point, radius, depth)
 
-    def find_knn(self, point: Data, k: int) -> List[Tuple[int, Radius]]:
-        """ Finds and returns the k-nearest neighbors of point. """
-        radius: Radius = np.float64(np.mean([c.radius for c in self.layers[-1]]))
-        radius = np.float64(max(radius, 1e-16))
+    def find_knn(
+            self,
+            point: Data,
+            k: int,
+            *,
+            max_distances: int = None,
+            max_leaves: int = None,
+            depth: int = None,
+    ) -> List[Tuple[int, Radius]]:
+        """ Finds and returns the k-nearest neighbors of point.
+
+        With any of the budgets, the search is approximate, see _best_first.
+
+        :param point: the query point.
+        :param k: the number of neighbors to find.
+        :param max_distances: Optional. Number of distance evaluations after which to stop.
+        :param max_leaves: Optional. Number of clusters whose points to scan before stopping.
+        :param depth: Optional. Depth at which to scan clusters instead of descending further.
+        :return: list of indices of neighbors and distances to them, nearest first.
+        """
+        population: int = self.root.cardinality - len(self.tombstones)
+        if k > population:
+            raise ValueError(f'k must not be greater than the number of points in the manifold. '
+                             f'Got k: {k}, population: {population}')
+
+        if any((budget is not None for budget in (max_distances, max_leaves, depth))):
+            results = self._best_first(point, k=k, max_distances=max_distances, max_leaves=max_leaves, depth=depth)
+            return sorted(results.items(), key=itemgetter(1))
+
+        radius: Radius = np.float64(max(self._mean_leaf_radius(), 1e-16))
         results = self.find_points(point, radius)
         while len(results) < k:
             radius *= 2
@@ -1287,11 +2236,461 @@ class Manifold:
 
         return sorted(results, key=itemgetter(1))[:k]
 
+    def _best_first(
+            self,
+            point: Data,
+            *,
+            k: int = None,
+            radius: Radius = None,
+            max_distances: int = None,
+            max_leaves: int = None,
+            depth: int = None,
+    ) -> Dict[int, Radius]:
+        """ Searches clusters in order of how near to point any of their points could be.
+
+        Clusters are never visited if they cannot hold a point within radius,
+        or nearer than the k-th nearest point found so far.
+        The search stops early, with the best results found so far, once any budget is spent.
+        Budgets are checked before each cluster is visited, so the last cluster may overspend them.
+        Scanning a cluster costs as many distance evaluations as it holds points, deleted or not.
+        Without budgets, the results are exact.
+
+        :return: dictionary of indices of points to distances.
+        """
+        for name, budget in (('max_distances', max_distances), ('max_leaves', max_leaves)):
+            if budget is not None and budget < 1:
+                raise ValueError(f'{name} must be positive. Got {budget}')
+        if depth is not None and depth < -1:
+            raise ValueError(f'depth must be -1 or non-negative. Got {depth}')
+        depth = sys.maxsize if depth is None or depth == -1 else depth
+        max_distances = sys.maxsize if max_distances is None else max_distances
+        max_leaves = sys.maxsize if max_leaves is None else max_leaves
+
+        point = np.expand_dims(np.asarray(point), axis=0)
+        hits: Dict[int, Radius] = dict()
+        # for knn, the nearest points found so far, and distances to them.
+        nearest, nearest_distances = np.zeros(shape=(0,), dtype=np.int64), np.zeros(shape=(0,), dtype=np.float64)
+
+        distance = float(self.distance(point, [self.root.argmedoid])[0][0])
+        evaluations, leaves = 1, 0
+        # clusters by the least distance from point to any point they could hold, with ids to break ties.
+        queue: List[Tuple[float, int, Cluster]] = [(max(0., distance - self.root.radius), self.root.id, self.root)]
+        while queue:
+            if k is None:
+                limit = radius
+            else:
+                limit = np.max(nearest_distances) if len(nearest) == k else np.inf
+
+            # the most promising clusters are visited a few at a time, so they share calls to the distance function.
+            expanded: List[Cluster] = list()
+            scanned: List[Cluster] = list()
+            while queue and len(expanded) + len(scanned) < BEST_FIRST_WIDTH and queue[0][0] <= limit:
+                if evaluations >= max_distances or leaves + len(scanned) >= max_leaves:
+                    break
+                cluster = heapq.heappop(queue)[2]
+                self._expand(cluster)
+                if cluster.children and cluster.depth < depth:
+                    expanded.append(cluster)
+                    evaluations += len(cluster.children)
+                else:
+                    scanned.append(cluster)
+                    evaluations += cluster.cardinality
+            if not (expanded or scanned):
+                break
+
+            if expanded:
+                children = [child for cluster in expanded for child in cluster.children]
+                distances = self.distance(point, [child.argmedoid for child in children])[0]
+                for child, distance in zip(children, distances):
+                    heapq.heappush(queue, (max(0., float(distance) - child.radius), child.id, child))
+
+            leaves += len(scanned)
+            argpoints = np.fromiter(chain.from_iterable(c.argpoints for c in scanned), dtype=np.int64)
+            if self.tombstones:
+                argpoints = argpoints[~np.isin(argpoints, list(self.tombstones))]
+            for i in range(0, len(argpoints), BATCH_SIZE):
+                batch = argpoints[i:i + BATCH_SIZE]
+                distances = self.distance(point, batch)[0]
+                if k is None:
+                    hits.update({int(p): d for p, d in zip(batch, distances) if d <= radius})
+                    continue
+                nearest = np.concatenate([nearest, batch])
+                nearest_distances = np.concatenate([nearest_distances, distances])
+                if len(nearest) > k:
+                    keep = np.argpartition(nearest_distances, k - 1)[:k]
+                    nearest, nearest_distances = nearest[keep], nearest_distances[keep]
+
+        logging.debug(f'best-first search made {evaluations} distance evaluations and scanned {leaves} clusters')
+        return hits if k is None else {int(p): d for p, d in zip(nearest, nearest_distances)}
+
+    def find_pairs(
+            self,
+            radius: Radius,
+            other: 'Manifold' = None,
+            *,
+            distances: bool = False,
+            chunk_size: int = BATCH_SIZE,
+    ) -> Iterable[Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]]:
+        """ Finds all pairs of points within radius of each other by descending two Cluster-trees together.
+
+        A pair of clusters is dropped when its medoids are farther apart than radius plus both radii,
+        and all of its points are paired at once when its medoids are within radius less both radii.
+        Only pairs of leaves that are neither are compared point by point.
+
+        :param radius: the largest distance between the points of a pair.
+        :param other: Optional. Manifold, with the same metric, whose points to pair with the points of this one.
+                      Defaults to this manifold, in which case every pair is found once, with the smaller index first.
+        :param distances: Whether to also yield the distance between the points of each pair.
+        :param chunk_size: the least number of pairs to yield at a time, except for the last chunk.
+        :return: generator of arrays of pairs, with indices into this manifold's data in the first column
+                 and into other's data in the second, and, if requested, arrays of distances.
+        """
+        if radius < 0:
+            raise ValueError(f'radius must be non-negative. Got {radius}')
+        if chunk_size < 1:
+            raise ValueError(f'chunk_size must be positive. Got {chunk_size}')
+        joint: bool = other is None or other is self
+        other = self if other is None else other
+        if other.metric != self.metric:
+            raise ValueError(f'manifolds must have the same metric. Got {self.metric} and {other.metric}')
+
+        def _pairs(lefts: List[Cluster], rights: List[Cluster], within: bool) -> Iterable[Tuple[np.ndarray, np.ndarray]]:
+            # pairs up the points of corresponding clusters, for all of them at once.
+            # within is whether all of those pairs are known to be within radius.
+            left_sizes = np.asarray([len(cluster.argpoints) for cluster in lefts], dtype=np.int64)
+            right_sizes = np.asarray([len(cluster.argpoints) for cluster in rights], dtype=np.int64)
+            left_points = np.fromiter(chain.from_iterable(c.argpoints for c in lefts), dtype=np.int64, count=np.sum(left_sizes))
+            right_points = np.fromiter(chain.from_iterable(c.argpoints for c in rights), dtype=np.int64, count=np.sum(right_sizes))
+            left_offsets, right_offsets = np.cumsum(left_sizes) - left_sizes, np.cumsum(right_sizes) - right_sizes
+            same = np.asarray([left is right for left, right in zip(lefts, rights)], dtype=bool) if joint else None
+
+            # every pair of points gets a position, and positions are handled a bounded number at a time.
+            ends = np.cumsum(left_sizes * right_sizes)
+            for start in range(0, int(ends[-1]) if len(ends) else 0, BATCH_SIZE * 100):
+                positions = np.arange(start, min(start + BATCH_SIZE * 100, int(ends[-1])), dtype=np.int64)
+                owners = np.searchsorted(ends, positions, side='right')
+                local = positions - (ends[owners] - left_sizes[owners] * right_sizes[owners])
+                left = left_points[left_offsets[owners] + local // right_sizes[owners]]
+                right = right_points[right_offsets[owners] + local % right_sizes[owners]]
+
+                mask = np.ones(shape=(len(positions),), dtype=bool)
+                if joint:
+                    # points paired within one cluster are only kept once.
+                    mask &= ~same[owners] | (left < right)
+                if self.tombstones or other.tombstones:
+                    mask &= ~np.isin(left, list(self.tombstones)) & ~np.isin(right, list(other.tombstones))
+                left, right = left[mask], right[mask]
+
+                values = None
+                if distances or not within:
+                    values = self.paired_distance(self.data[left], other.data[right])
+                    if not within:
+                        mask = values <= radius
+                        left, right, values = left[mask], right[mask], values[mask]
+
+                pairs = np.stack([left, right], axis=1)
+                if joint:
+                    pairs.sort(axis=1)
+                yield pairs, values
+
+        chunk: List[Tuple[np.ndarray, np.ndarray]] = list()
+        count: int = 0
+        stack: List[List[Tuple[Cluster, Cluster]]] = [[(self.root, other.root)]]
+        while stack:
+            batch = stack.pop()
+            for left, right in batch:
+                self._expand(left), other._expand(right)
+
+            lefts, rights = [left for left, _ in batch], [right for _, right in batch]
+            if joint:
+                medoid_distances = self.medoid_distances(lefts, rights)
+            else:
+                medoid_distances = self.paired_distance(
+                    self.data[[left.argmedoid for left in lefts]],
+                    other.data[[right.argmedoid for right in rights]],
+                )
+            left_radii = np.asarray([left.radius for left in lefts], dtype=np.float64)
+            right_radii = np.asarray([right.radius for right in rights], dtype=np.float64)
+            overlapping = medoid_distances <= left_radii + right_radii + radius
+            within = medoid_distances + left_radii + right_radii <= radius
+
+            # pairs of clusters that are neither within range nor out of range are split further.
+            children: List[Tuple[Cluster, Cluster]] = list()
+            leaves: List[int] = list()
+            for i in np.flatnonzero(overlapping & ~within):
+                left, right = lefts[i], rights[i]
+                if joint and left is right:
+                    children.extend(combinations_with_replacement(left.children or [], 2))
+                    if not left.children:
+                        leaves.append(i)
+                elif left.children and (not right.children or left_radii[i] >= right_radii[i]):
+                    children.extend((child, right) for child in left.children)
+                elif right.children:
+                    children.extend((left, child) for child in right.children)
+                else:
+                    leaves.append(i)
+
+            within = np.flatnonzero(within)
+            for results in (
+                    _pairs([lefts[i] for i in within], [rights[i] for i in within], True),
+                    _pairs([lefts[i] for i in leaves], [rights[i] for i in leaves], False),
+            ):
+                for pairs, values in results:
+                    chunk.append((pairs, values))
+                    count += len(pairs)
+                    if count >= chunk_size:
+                        pairs = np.concatenate([pairs for pairs, _ in chunk])
+                        yield (pairs, np.concatenate([values for _, values in chunk])) if distances else pairs
+                        chunk, count = list(), 0
+
+            stack.extend(children[i:i + BATCH_SIZE] for i in range(0, len(children), BATCH_SIZE))
+
+        if count > 0:
+            pairs = np.concatenate([pairs for pairs, _ in chunk])
+            yield (pairs, np.concatenate([values for _, values in chunk])) if distances else pairs
+        return
+
+    def knn_graph(self, k: int, *, workers: int = None) -> sparse.csr_matrix:
+        """ Finds the k-nearest neighbors of every point in the manifold.
+
+        Points are handled a leaf at a time. The first candidate neighbors of the points in a leaf are the points
+        in the leaf and in its neighbors in the graph of leaves. If the k-th nearest candidate of any point
+        in the leaf is at distance t, every leaf within radius + t of its medoid is then found,
+        for all leaves at once, and leaves that held any missing candidates are searched again.
+
+        :param k: number of neighbors of each point, not counting the point itself.
+        :param workers: Optional. Number of threads among which to divide the leaves.
+        :return: sparse matrix, over all of data, with the distances from each point in the manifold
+                 to its k-nearest neighbors in row and column positions given by their indices in data.
+        """
+        population: int = self.root.cardinality - len(self.tombstones)
+        if not 0 < k < population:
+            raise ValueError(f'k must be positive and less than the number of points in the manifold. '
+                             f'Got k: {k}, population: {population}')
+
+        leaves = self.layers[-1]
+        if leaves.adjacency is None:
+            self._mutable('build the graph of leaves of')
+            self.root.candidates = {self.root: 0.}
+            leaves.build_edges()
+        tombstones = np.asarray(list(self.tombstones), dtype=np.int64)
+
+        def _points(clusters: Iterable[Cluster]) -> np.ndarray:
+            points = np.unique(np.fromiter(chain.from_iterable(c.argpoints for c in clusters), dtype=np.int64))
+            return points[~np.isin(points, tombstones)] if len(tombstones) else points
+
+        def _neighborhood(leaf: Cluster) -> Set[Cluster]:
+            clusters: Set[Cluster] = {leaf}.union(leaves.neighbors(leaf))
+            if len(_points(clusters)) <= k:
+                # too few candidates, so add the smallest ancestor with enough points.
+                clusters.add(next(a for a in reversed(self.ancestry(leaf)) if len(_points([a])) > k))
+            return clusters
+
+        def _knn(leaf: Cluster, clusters: Set[Cluster]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            # the k-nearest candidates, among the points in clusters, of every point in the leaf.
+            points, candidates = _points([leaf]), _points(clusters)
+            if len(points) == 0:
+                return points, points.reshape(0, k), np.zeros(shape=(0, k), dtype=np.float64)
+            distances = self.distance(self.data[points], self.data[candidates])
+            distances[points[:, None] == candidates[None, :]] = np.inf
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            distances = np.take_along_axis(distances, nearest, axis=1)
+            order = np.argsort(distances, axis=1)
+            return points, candidates[np.take_along_axis(nearest, order, axis=1)], np.take_along_axis(distances, order, axis=1)
+
+        logging.info(f'finding {k}-nearest neighbors of {population} points in {leaves.cardinality} leaves')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            neighborhoods: List[Set[Cluster]] = list(executor.map(_neighborhood, leaves.members))
+            results = list(executor.map(_knn, leaves.members, neighborhoods))
+
+            # find every leaf that could hold a nearer neighbor than the k-th candidate.
+            radii = np.asarray([
+                leaf.radius + (np.max(distances[:, -1]) if len(distances) else -np.inf)
+                for leaf, (_, _, distances) in zip(leaves.members, results)
+            ], dtype=np.float64)
+            found = self._overlapping(leaves.members, radii)
+
+            missed = [i for i in range(leaves.cardinality) if not found[i].issubset(neighborhoods[i])]
+            logging.debug(f'searching again for the neighbors of {len(missed)} leaves')
+            retries = executor.map(_knn, [leaves.members[i] for i in missed], [neighborhoods[i] | found[i] for i in missed])
+            for i, result in zip(missed, retries):
+                results[i] = result
+
+        rows = np.concatenate([points for points, _, _ in results])
+        columns = np.concatenate([neighbors for _, neighbors, _ in results])
+        distances = np.concatenate([distances for _, _, distances in results])
+        order = np.argsort(rows, kind='stable')
+        indptr = np.zeros(shape=(self.data.shape[0] + 1,), dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=self.data.shape[0]) * k, out=indptr[1:])
+        return sparse.csr_matrix(
+            (distances[order].ravel(), columns[order].ravel(), indptr),
+            shape=(self.data.shape[0], self.data.shape[0]),
+        )
+
+    def _overlapping(self, clusters: List[Cluster], radii: np.ndarray) -> List[Set[Cluster]]:
+        """ Finds, for each cluster, the leaves that overlap a ball of the given radius around its medoid.
+
+        All clusters descend the tree together, one level at a time, with medoid distances from distance_cache.
+        Clusters with a negative radius overlap nothing.
+        """
+        found: List[Set[Cluster]] = [set() for _ in clusters]
+        pairs: List[Tuple[int, Cluster]] = [(i, self.root) for i in np.flatnonzero(radii >= 0)]
+        while pairs:
+            [self._expand(cluster) for _, cluster in pairs if cluster.children is None]
+            distances = self.medoid_distances([clusters[i] for i, _ in pairs], [cluster for _, cluster in pairs])
+            bounds = radii[[i for i, _ in pairs]] + np.asarray([cluster.radius for _, cluster in pairs], dtype=np.float64)
+
+            descendants: List[Tuple[int, Cluster]] = list()
+            for (i, cluster), overlaps in zip(pairs, distances <= bounds):
+                if not overlaps:
+                    continue
+                elif cluster.children:
+                    descendants.extend((i, child) for child in cluster.children)
+                else:
+                    found[i].add(cluster)
+            pairs = descendants
+        return found
+
+    def delete(self, indices: Vector) -> 'Manifold':
+        """ Marks points as deleted.
+
+        Deleted points are excluded from search results right away.
+        Clusters keep holding them until the next call to compact.
+
+        :param indices: indices, into data, of the points to delete.
+        :return: the manifold, for chaining.
+        """
+        self._mutable('delete points from')
+        indices: Set[int] = set(map(int, indices))
+        missing: Set[int] = indices - set(self.root.argpoints)
+        if missing:
+            raise ValueError(f'Cannot delete points that are not in the manifold. Got: {sorted(missing)}')
+
+        self.tombstones.update(indices)
+        return self
+
+    def compact(self) -> 'Manifold':
+        """ Removes deleted points from the Cluster-tree, the Graph-stack and the Graph.
+
+        Clusters that are left without any points are dropped from the tree and from every graph.
+        Clusters that lost points draw new samples from the points they keep,
+        and their medoids, radii and local fractal dimensions are computed again.
+        Candidates are then found again, and the edges of every graph that had them are rebuilt.
+
+        :return: the manifold, for chaining.
+        """
+        self._mutable('compact')
+        if not self.tombstones:
+            return self
+        logging.info(f'compacting {len(self.tombstones)} deleted points')
+
+        removed: Set[Cluster] = set()
+        changed: List[Cluster] = list()
+        argpoints = [p for p in self.root.argpoints if p not in self.tombstones]
+        if len(argpoints) < self.root.cardinality:
+            self.root.argpoints = argpoints
+            changed.append(self.root)
+        clusters: List[Cluster] = [self.root]
+        while clusters:
+            cluster = clusters.pop()
+            if cluster.children:
+                for child in cluster.children:
+                    argpoints = [p for p in child.argpoints if p not in self.tombstones]
+                    if len(argpoints) < child.cardinality:
+                        child.argpoints = argpoints
+                        changed.append(child)
+
+                empty: List[Cluster] = [child for child in cluster.children if not child.argpoints]
+                for child in empty:
+                    cluster.children.remove(child)
+                    subtree: List[Cluster] = [child]
+                    while subtree:
+                        descendant = subtree.pop()
+                        removed.add(descendant)
+                        subtree.extend(descendant.children or [])
+
+                clusters.extend(cluster.children)
+
+        # samples, and everything computed from them, come from the points that are left.
+        changed = [cluster for cluster in changed if cluster not in removed]
+        [cluster.clear_cache() for cluster in changed]
+        [cluster._fill_cache() for cluster in changed]
+
+        if changed:
+            for cluster in self.clusters:
+                cluster.candidates = None
+            self.layers = Layers(self, depth=min(self.depth, Layers(self).depth))
+
+            self.root.candidates = {self.root: 0.}
+
+            built: bool = self.graph.adjacency is not None
+            self.graph = Graph(*[cluster for cluster in self.graph if cluster not in removed])
+            if built and self.graph:
+                self.graph.build_edges()
+
+            for name, graph in list(self.graphs.items()):
+                built = graph.adjacency is not None
+                self.graphs[name] = Graph(*[cluster for cluster in graph if cluster not in removed])
+                if built and self.graphs[name]:
+                    self.graphs[name].build_edges()
+
+        self.argpoints = [p for p in self.argpoints if p not in self.tombstones]
+        self.removed.update(self.tombstones)
+        self.tombstones.clear()
+        self.clear_cache()
+        return self
+
+    def freeze(self) -> 'Manifold':
+        """ Precomputes every lazily cached value that searches read, and makes the manifold immutable.
+
+        A lazily built tree is built out in full. Every cluster in the tree gets its samples, medoid, radius
+        and local fractal dimension, and the graph, the named graphs and the graph of leaves, which knn_graph uses,
+        get their edges, walkable clusters and components. The frozen manifold holds on to the graph of leaves.
+        Afterwards, find_points, find_knn, knn_graph, assign and the other searches only read from the manifold,
+        and draw nothing from np.random, so they may run concurrently from many threads.
+        Anything that would change the manifold raises a ValueError, i.e. build, build_tree, build_graph,
+        extend, delete, compact, Graph.replace_clusters, graph criteria such as MinimizeSubsumed,
+        and building edges for a graph whose clusters still lack candidates.
+        The LRU cache of medoid distances stays in use, behind its lock.
+
+        :return: the manifold, for chaining.
+        """
+        if self.frozen:
+            return self
+        if self.lazy_criteria is not None:
+            logging.info(f'expanding lazily built tree')
+            self._expand_all()
+            self._build_layers()
+            self.lazy_criteria = None
+
+        logging.info(f'freezing manifold')
+        clusters: List[Cluster] = [self.root]
+        while clusters:
+            cluster = clusters.pop()
+            cluster._fill_cache()
+            clusters.extend(cluster.children or [])
+
+        if self.root.candidates is None:
+            self.root.candidates = {self.root: 0.}
+        self.cache['leaves_graph'] = self.layers[-1]
+        for graph in [self.graph, *self.graphs.values(), self.cache['leaves_graph']]:
+            if graph.adjacency is None:
+                graph.build_edges()
+            _ = graph.walkable_clusters, graph.walkable_adjacency, graph.components
+
+        _ = str(self), self._mean_leaf_radius()
+        self.frozen = True
+        return self
+
     def dump(self, fp: Union[BinaryIO, IO[bytes]]) -> None:
         pickle.dump({
             'metric': self.metric,
             'root': self.root.json(),
-            'graph': [cluster.name for cluster in self.graph.clusters]
+            'graph': self.graph.json(),
+            'graphs': {name: graph.json() for name, graph in self.graphs.items()},
+            'argpoints': list(map(int, self.argpoints)),
+            'tombstones': sorted(self.tombstones),
+            'removed': sorted(self.removed),
         }, fp, protocol=pickle.HIGHEST_PROTOCOL)
         return
 
@@ -1301,22 +2700,26 @@ class Manifold:
         manifold = Manifold(data, metric=d['metric'])
 
         manifold.root = Cluster.from_json(manifold, d['root'])
-        manifold.layers = [Graph(manifold.root)]
-        while True:
-            for cluster in manifold.layers[-1]:
-                if cluster.cache['candidates'] is None:
-                    cluster.candidates = None
-                else:
-                    cluster.candidates = {manifold.select(c): d for c, d in cluster.cache['candidates'].items()}
-
-            childless = [cluster for cluster in manifold.layers[-1] if not cluster.children]
-            with_child = [cluster for cluster in manifold.layers[-1] if cluster.children]
-            if with_child:
-                graph = childless + [child for cluster in with_child for child in cluster.children]
-                manifold.layers.append(Graph(*graph))
+        # files written before argpoints were saved hold only the points in the tree.
+        manifold.argpoints = d['argpoints'] if 'argpoints' in d else manifold.root.argpoints
+        manifold.tombstones = set(d.get('tombstones', list()))
+        manifold._build_layers()
+        for cluster in manifold.clusters:
+            if cluster.cache['candidates'] is None:
+                cluster.candidates = None
             else:
-                break
+                cluster.candidates = {manifold.select(c): d for c, d in cluster.cache['candidates'].items()}
 
-        manifold.graph = Graph(*[manifold.select(cluster) for cluster in d['graph']]).build_edges()
+        if type(d['graph']) is list:
+            # written before graphs were saved with their edges
+            manifold.graph = Graph(*[manifold.select(cluster) for cluster in d['graph']]).build_edges()
+        else:
+            manifold.graph = Graph.from_json(manifold, d['graph'])
+            if manifold.graph.adjacency is None:
+                if manifold.root.candidates is None:
+                    manifold.root.candidates = {manifold.root: 0.}
+                manifold.graph.build_edges()
+        manifold.graphs = {name: Graph.from_json(manifold, graph) for name, graph in d.get('graphs', dict()).items()}
+        manifold.removed = set(d.get('removed', list()))
 
         return manifold
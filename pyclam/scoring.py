@@ -0,0 +1,271 @@
+""" Anomaly scores from ensembles of graphs.
+
+Every measure gives a raw score to each cluster in a graph, by row of the graph, where higher is more anomalous.
+Raw scores are normalized into [0, 1] within each graph, scattered to the points in the clusters,
+and the scores from every graph and measure are then voted into one score per point.
+"""
+import concurrent.futures
+import logging
+from typing import Dict, List, Callable
+
+import numpy as np
+from scipy import sparse
+from scipy.special import erf
+
+from pyclam.manifold import Manifold, Graph
+from pyclam.types import Data
+
+__all__ = [
+    'MEASURES',
+    'NORMALIZATIONS',
+    'cardinality',
+    'component_cardinality',
+    'neighborhood',
+    'random_walks',
+    'stationary',
+    'normalize',
+    'cluster_scores',
+    'point_scores',
+    'score',
+    'Scorer',
+]
+
+
+def cardinality(graph: Graph, **kwargs) -> np.ndarray:
+    """ Clusters with fewer points are more anomalous. """
+    return -np.asarray([cluster.cardinality for cluster in graph.members], dtype=np.float64)
+
+
+def component_cardinality(graph: Graph, **kwargs) -> np.ndarray:
+    """ Clusters in components with fewer clusters are more anomalous. """
+    components = graph.components
+    return -np.bincount(components)[components].astype(np.float64)
+
+
+def neighborhood(graph: Graph, *, hops: int = 1, **kwargs) -> np.ndarray:
+    """ Clusters that reach fewer clusters within the given number of hops along edges are more anomalous. """
+    if graph.adjacency is None:
+        graph.build_edges()
+    indptr, indices = graph.adjacency.indptr, graph.adjacency.indices
+    if hops == 1:
+        return -(np.diff(indptr) + 1).astype(np.float64)
+
+    adjacency = sparse.csr_matrix(
+        (np.ones(shape=(len(indices),), dtype=bool), indices, indptr),
+        shape=(graph.cardinality, graph.cardinality),
+    )
+    reached = sparse.identity(graph.cardinality, dtype=bool, format='csr')
+    for _ in range(hops):
+        reached = reached + reached @ adjacency
+    return -np.diff(reached.indptr).astype(np.float64)
+
+
+def random_walks(graph: Graph, *, steps: int = 100, seed: int = None, **kwargs) -> np.ndarray:
+    """ Clusters visited less often by random walks, started from every walkable cluster, are more anomalous. """
+    if graph.adjacency is None:
+        graph.build_edges()
+    starts = [cluster for cluster in graph.members if cluster in graph.walkable_clusters]
+    visits = graph.random_walks(starts, steps, seed=seed)
+    return -np.asarray([visits[cluster] for cluster in graph.members], dtype=np.float64)
+
+
+def stationary(graph: Graph, *, tolerance: float = 1e-8, **kwargs) -> np.ndarray:
+    """ Clusters with lower stationary probabilities of random walks, within their components, are more anomalous. """
+    distribution = graph.stationary_distribution(tolerance=tolerance)
+    return -np.asarray([distribution[cluster] for cluster in graph.members], dtype=np.float64)
+
+
+MEASURES: Dict[str, Callable[..., np.ndarray]] = {
+    'cardinality': cardinality,
+    'component_cardinality': component_cardinality,
+    'neighborhood': neighborhood,
+    'random_walks': random_walks,
+    'stationary': stationary,
+}
+
+
+def _linear(values: np.ndarray) -> np.ndarray:
+    spread = np.max(values) - np.min(values)
+    return (values - np.min(values)) / spread if spread > 0 else np.full_like(values, 0.5)
+
+
+def _gaussian(values: np.ndarray) -> np.ndarray:
+    std = np.std(values)
+    return 0.5 * (1. + erf((values - np.mean(values)) / (std * np.sqrt(2.)))) if std > 0 else np.full_like(values, 0.5)
+
+
+def _sigmoid(values: np.ndarray) -> np.ndarray:
+    std = np.std(values)
+    return 1. / (1. + np.exp(-(values - np.mean(values)) / std)) if std > 0 else np.full_like(values, 0.5)
+
+
+NORMALIZATIONS: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    'linear': _linear,
+    'gaussian': _gaussian,
+    'sigmoid': _sigmoid,
+}
+
+
+def normalize(values: np.ndarray, normalization: str = 'gaussian') -> np.ndarray:
+    """ Normalizes scores into [0, 1]. Constant scores are all normalized to 0.5.
+
+    :param values: vector of scores.
+    :param normalization: 'linear' for min-max, 'gaussian' for the normal cdf of z-scores, or 'sigmoid' of z-scores.
+    :return: vector of normalized scores.
+    """
+    if normalization not in NORMALIZATIONS:
+        raise ValueError(f'normalization must be one of {list(NORMALIZATIONS.keys())}. Got {normalization}')
+    values = np.asarray(values, dtype=np.float64)
+    return NORMALIZATIONS[normalization](values) if len(values) > 0 else values
+
+
+def cluster_scores(
+        graph: Graph,
+        measures: List[str] = None,
+        normalization: str = 'gaussian',
+        **parameters,
+) -> Dict[str, np.ndarray]:
+    """ Computes normalized scores for every cluster in the graph.
+
+    :param graph: graph whose clusters to score.
+    :param measures: Optional. Names of measures from MEASURES. Defaults to all measures.
+    :param normalization: see normalize.
+    :param parameters: passed on to every measure, e.g. hops, steps, seed, tolerance.
+    :return: dictionary of measure name to vector of scores, by row of the graph.
+    """
+    measures = list(MEASURES.keys()) if measures is None else measures
+    unknown = [measure for measure in measures if measure not in MEASURES]
+    if unknown:
+        raise ValueError(f'measures must be among {list(MEASURES.keys())}. Got {unknown}')
+    logging.debug(f'scoring {graph.cardinality} clusters with {measures}')
+    return {measure: normalize(MEASURES[measure](graph, **parameters), normalization) for measure in measures}
+
+
+def point_scores(graph: Graph, scores: np.ndarray) -> np.ndarray:
+    """ Gives every point the score of the cluster it belongs to in the graph.
+
+    :param graph: graph whose clusters were scored.
+    :param scores: vector of scores, by row of the graph.
+    :return: vector of scores for every point in the data. Points not in the graph, or deleted, have NaN scores.
+             An empty graph knows of no manifold, and so of no data, and gives an empty vector.
+    """
+    if graph.cardinality == 0:
+        return np.zeros(shape=(0,), dtype=np.float64)
+
+    manifold = graph.manifold
+    results = np.full(shape=(manifold.data.shape[0],), fill_value=np.nan, dtype=np.float64)
+    counts = [cluster.cardinality for cluster in graph.members]
+    points = np.concatenate([np.asarray(cluster.argpoints, dtype=np.int64) for cluster in graph.members])
+    results[points] = np.repeat(np.asarray(scores, dtype=np.float64), counts)
+    if manifold.tombstones:
+        results[list(manifold.tombstones)] = np.nan
+    return results
+
+
+def score(
+        manifold: Manifold,
+        graphs: List[Graph] = None,
+        *,
+        measures: List[str] = None,
+        normalization: str = 'gaussian',
+        voting: str = 'mean',
+        workers: int = None,
+        **parameters,
+) -> np.ndarray:
+    """ Scores every point in the manifold by voting among the scores from an ensemble of graphs.
+
+    :param manifold: manifold whose points to score.
+    :param graphs: Optional. Graphs to use. Defaults to manifold.graph and the graphs in manifold.graphs.
+    :param measures: Optional. Names of measures from MEASURES. Defaults to all measures.
+    :param normalization: see normalize.
+    :param voting: 'mean' or 'max' of the scores of each point across every graph and measure.
+    :param workers: Optional. Number of threads among which to divide the graphs.
+    :param parameters: passed on to every measure, e.g. hops, steps, seed, tolerance.
+    :return: vector of scores for every point in the data. Points in none of the graphs have NaN scores.
+    """
+    if voting not in {'mean', 'max'}:
+        raise ValueError(f'voting must be one of \'mean\' or \'max\'. Got {voting}')
+
+    graphs = [manifold.graph] + list(manifold.graphs.values()) if graphs is None else graphs
+    # edges are built beforehand because graphs from one tree share candidates among their clusters.
+    [graph.build_edges() for graph in graphs if graph.adjacency is None]
+
+    def _score(graph: Graph) -> List[np.ndarray]:
+        scores = cluster_scores(graph, measures, normalization, **parameters)
+        return [point_scores(graph, values) for values in scores.values()]
+
+    if workers is None or workers < 2:
+        results = [_score(graph) for graph in graphs]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_score, graphs))
+
+    votes = np.stack([values for result in results for values in result])
+    covered = np.any(~np.isnan(votes), axis=0)
+    scores: np.ndarray = np.full(shape=(votes.shape[1],), fill_value=np.nan, dtype=np.float64)
+    vote = np.nanmean if voting == 'mean' else np.nanmax
+    scores[covered] = vote(votes[:, covered], axis=0)
+    return scores
+
+
+class Scorer:
+    """ Scores new points against a fixed manifold and graph.
+
+    Cluster scores are computed once, at construction, into tables indexed by cluster id.
+    A batch of points is then scored by descending the tree, all points at once, to the graph cluster each falls into,
+    and looking up the scores of that cluster. Neither the manifold nor the graph is changed.
+    """
+    def __init__(
+            self,
+            manifold: Manifold,
+            graph: Graph = None,
+            *,
+            measures: List[str] = None,
+            normalization: str = 'gaussian',
+            **parameters,
+    ):
+        """
+        :param manifold: manifold against which to score points.
+        :param graph: Optional. Graph whose clusters to score. Defaults to manifold.graph.
+        :param measures: Optional. Names of measures from MEASURES. Defaults to all measures.
+        :param normalization: see normalize.
+        :param parameters: passed on to every measure, e.g. hops, steps, seed, tolerance.
+        """
+        self.manifold: Manifold = manifold
+        self.graph: Graph = manifold.graph if graph is None else graph
+        if self.graph.adjacency is None:
+            self.graph.build_edges()
+
+        ids = np.asarray([cluster.id for cluster in self.graph.members], dtype=np.int64)
+        size = len(manifold.clusters)
+
+        # Tables, indexed by cluster id, of the scores of each measure.
+        # Clusters not in the graph have NaN scores.
+        self.tables: Dict[str, np.ndarray] = dict()
+        for measure, values in cluster_scores(self.graph, measures, normalization, **parameters).items():
+            self.tables[measure] = np.full(shape=(size,), fill_value=np.nan, dtype=np.float64)
+            self.tables[measure][ids] = values
+        self.table: np.ndarray = np.mean(np.stack(list(self.tables.values())), axis=0)
+
+        # Table, indexed by cluster id, of the component of each cluster in the graph, or -1.
+        self.components: np.ndarray = np.full(shape=(size,), fill_value=-1, dtype=np.int64)
+        self.components[ids] = self.graph.components
+        return
+
+    def assign(self, points: Data) -> np.ndarray:
+        """ Returns the ids of the graph clusters into which points fall. See Manifold.assign. """
+        return self.manifold.assign(points, graph=self.graph)
+
+    def score(self, points: Data) -> np.ndarray:
+        """ Returns the mean score across measures of the graph cluster into which each point falls. """
+        return self.table[self.assign(points)]
+
+    def scores(self, points: Data) -> Dict[str, np.ndarray]:
+        """ Returns, for every point, the id of its graph cluster, the component of that cluster, and the score for each measure.
+
+        :return: dictionary with 'cluster' and 'component' arrays, and an array for each measure.
+        """
+        ids = self.assign(points)
+        results = {'cluster': ids, 'component': self.components[ids]}
+        results.update({measure: table[ids] for measure, table in self.tables.items()})
+        return results
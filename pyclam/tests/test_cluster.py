@@ -28,6 +28,11 @@ class TestCluster(unittest.TestCase):
         self.assertEqual(self.cluster, self.cluster)
         self.assertNotEqual(self.cluster, self.children[0])
         self.assertNotEqual(self.children[0], self.children[1])
+
+        # clusters from another manifold are compared by name and points
+        other = Manifold(self.data, 'euclidean')
+        self.assertEqual(self.cluster, Cluster(other, self.manifold.argpoints, ''))
+        self.assertNotEqual(self.cluster, Cluster(other, self.manifold.argpoints[:10], ''))
         return
 
     def test_bool(self):
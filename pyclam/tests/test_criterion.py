@@ -1,5 +1,8 @@
 import unittest
 
+import numpy as np
+from scipy.spatial.distance import cdist
+
 from pyclam import Manifold, datasets, criterion
 
 
@@ -75,6 +78,58 @@ class TestCriterion(unittest.TestCase):
             self.assertEqual(1, included, f"expected exactly one ancestor to be in graph. Found {included}")
         return
 
+    def test_minimize_subsumed_budget(self):
+        with self.assertRaises(ValueError):
+            criterion.MinimizeSubsumed(0.2, max_iterations=-1)
+
+        self.manifold.build(criterion.MaxDepth(12), criterion.LFDRange(80, 20))
+        clusters = set(self.manifold.graph.clusters)
+        criterion.MinimizeSubsumed(1e-3, max_iterations=0)(self.manifold)
+        self.assertSetEqual(clusters, set(self.manifold.graph.clusters))
+
+        criterion.MinimizeSubsumed(1e-3, max_iterations=5)(self.manifold)
+        self.assertEqual(self.manifold.graph, type(self.manifold.graph)(*self.manifold.graph.clusters).build_edges())
+        return
+
+    def test_batch(self):
+        self.manifold.build_tree(criterion.MaxDepth(8))
+        factories = [
+            lambda: criterion.MaxDepth(4),
+            lambda: criterion.AddLevels(2),
+            lambda: criterion.MinPoints(20),
+            lambda: criterion.MinRadius(0.1),
+            lambda: criterion.MedoidNearCentroid(),
+            lambda: criterion.UniformDistribution(),
+        ]
+        for depth, layer in enumerate(self.manifold.layers):
+            clusters = list(layer)
+            properties = {
+                'depths': np.asarray([cluster.depth for cluster in clusters]),
+                'cardinalities': np.asarray([cluster.cardinality for cluster in clusters]),
+                'radii': np.asarray([cluster.radius for cluster in clusters]),
+                'lfds': np.asarray([cluster.local_fractal_dimension for cluster in clusters]),
+            }
+            for factory in factories:
+                single, batched = factory(), factory()
+                expected = [single(cluster) for cluster in clusters]
+                actual = list(batched.batch(clusters, **properties))
+                self.assertListEqual(expected, actual, f'{type(single).__name__} at depth {depth}')
+
+        # properties that no batch method takes are not computed.
+        manifold = Manifold(self.data, 'euclidean').build_tree(criterion.MaxDepth(4), criterion.MinRadius(0.1))
+        for layer in manifold.layers:
+            for cluster in layer:
+                self.assertNotIn('local_fractal_dimension', cluster.cache)
+        return
+
+    def test_paired_distance(self):
+        left, right = list(range(0, 100)), list(range(100, 200))
+        for metric in ['euclidean', 'sqeuclidean', 'cityblock', 'chebyshev', 'cosine', 'canberra']:
+            expected = np.diag(cdist(self.data[left], self.data[right], metric))
+            self.manifold.metric = metric
+            self.assertTrue(np.allclose(expected, self.manifold.paired_distance(left, right)), metric)
+        return
+
     # def plot(self):
     #     from inspect import stack
     #     from itertools import cycle
@@ -33,6 +33,12 @@ class TestGraph(unittest.TestCase):
         self.assertEqual(self.manifold.layers[0], self.manifold.layers[0])
         for left, right in combinations(self.manifold.layers, 2):
             self.assertNotEqual(left, right)
+
+        graph = self.manifold.graph
+        shuffled = Graph(*reversed(graph.members)).build_edges()
+        self.assertEqual(hash(graph), hash(shuffled))
+        self.assertEqual(graph, shuffled)
+        self.assertNotEqual(graph, Graph(*graph.members[1:]))
         return
 
     def test_iter(self):
@@ -70,11 +76,55 @@ class TestGraph(unittest.TestCase):
         )
         return
 
+    def test_adjacency(self):
+        graph = self.manifold.graph
+        indptr, indices, distances, probabilities = graph.adjacency
+        self.assertEqual(graph.cardinality + 1, len(indptr))
+        self.assertEqual(len(indices), indptr[-1])
+        for i, cluster in enumerate(graph.members):
+            self.assertEqual(graph.index[cluster], i)
+            row = slice(indptr[i], indptr[i + 1])
+            self.assertNotIn(i, indices[row])
+            self.assertListEqual(graph.neighbors(cluster), [graph.members[j] for j in indices[row]])
+            for neighbor, distance in zip(graph.neighbors(cluster), graph.distances(cluster)):
+                self.assertIn(Edge(cluster, distance, None), graph.edges[neighbor])
+            if cluster in graph.walkable_clusters and graph.walkable_edges[cluster]:
+                self.assertAlmostEqual(1., sum(graph.probabilities(cluster)), places=6)
+            else:
+                self.assertEqual(0., np.sum(probabilities[row][graph.walkable[indices[row]]]))
+        self.assertSetEqual(set(graph.clusters), set(graph.subsumed_edges.keys()))
+        self.assertSetEqual(graph.walkable_clusters, set(graph.walkable_edges.keys()))
+        return
+
+    def test_candidates(self):
+        for cluster in self.manifold.graph:
+            candidates = list(cluster.candidates.keys())
+            distances = cluster.distance_from([c.argmedoid for c in candidates])
+            self.assertTrue(np.allclose(distances, list(cluster.candidates.values())))
+            for neighbor in self.manifold.graph.neighbors(cluster):
+                self.assertTrue(neighbor in cluster.candidates or cluster in neighbor.candidates)
+        return
+
     def test_subgraphs(self):
         [self.assertIsInstance(subgraph, Graph) for subgraph in self.manifold.graph.subgraphs]
         self.assertEqual(self.manifold.graph.cardinality, sum(subgraph.cardinality for subgraph in self.manifold.graph.subgraphs))
         return
 
+    def test_components(self):
+        graph = self.manifold.graph
+        components = graph.components
+        self.assertEqual(graph.cardinality, len(components))
+        self.assertSetEqual(set(range(len(graph.subgraphs))), set(map(int, components)))
+        for cluster in graph.walkable_clusters:
+            subgraph = graph.subgraph(cluster)
+            self.assertIn(cluster, subgraph)
+            self.assertIs(subgraph, graph.subgraph(cluster))
+            reached = {c for c in graph.traverse(cluster) if c in graph.walkable_clusters}
+            self.assertSetEqual(reached, {c for c in subgraph.clusters if c in graph.walkable_clusters})
+        for cluster in graph.subsumed_clusters:
+            self.assertIn(cluster, graph.subgraph(cluster))
+        return
+
     def test_clear_cache(self):
         self.manifold.graph.clear_cache()
         _ = self.manifold.graph.cached_edges
@@ -95,6 +145,36 @@ class TestGraph(unittest.TestCase):
         self.assertLessEqual(len(visited), self.manifold.graph.cardinality)
         return
 
+    def test_hops(self):
+        graph = self.manifold.graph
+        starts = list(graph.walkable_clusters)[:5]
+        for start in starts:
+            # plain breadth-first search along walkable edges
+            expected, frontier = {start: 0}, [start]
+            while frontier:
+                cluster = frontier.pop(0)
+                for neighbor in graph.neighbors(cluster):
+                    if neighbor in graph.walkable_clusters and neighbor not in expected:
+                        expected[neighbor] = expected[cluster] + 1
+                        frontier.append(neighbor)
+            hops = graph.hops(start)
+            for cluster in graph.walkable_clusters:
+                self.assertEqual(expected.get(cluster, -1), hops[graph.index[cluster]])
+            self.assertSetEqual(graph.bft(start), {graph.members[i] for i in np.flatnonzero(hops >= 0)})
+            self.assertEqual(int(np.max(hops)), graph.eccentricity(start))
+
+        hops = np.stack([graph.hops(start) for start in starts])
+        hops[hops < 0] = np.iinfo(np.int64).max
+        expected = np.min(hops, axis=0)
+        expected[expected == np.iinfo(np.int64).max] = -1
+        self.assertListEqual(list(expected), list(graph.hops(starts)))
+        self.assertTrue(np.all(graph.hops(starts, max_hops=1) <= 1))
+
+        if graph.subsumed_clusters:
+            with self.assertRaises(ValueError):
+                graph.hops(next(iter(graph.subsumed_clusters)))
+        return
+
     def test_random_walks(self):
         results = self.manifold.graph.random_walks(
             starts=list(self.manifold.graph.walkable_clusters),
@@ -104,43 +184,86 @@ class TestGraph(unittest.TestCase):
         [self.assertGreater(v, 0) for k, v in results.items()]
         return
 
-    @unittest.skip
+    def test_random_walks_seed(self):
+        graph = self.manifold.graph
+        starts = list(graph.walkable_clusters)
+        results = graph.random_walks(starts, steps=20, seed=7)
+        self.assertDictEqual(results, graph.random_walks(starts, steps=20, seed=7))
+
+        walkers = sum(1 for cluster in starts if graph.walkable_edges[cluster])
+        self.assertEqual(len(starts) + 20 * walkers, sum(results[cluster] for cluster in graph.walkable_clusters))
+        for cluster in graph.subsumed_clusters:
+            expected = sum(results[neighbor] for neighbor in graph.neighbors(cluster) if neighbor in graph.walkable_clusters)
+            self.assertEqual(expected, results[cluster])
+
+        expected = graph.expected_visits(starts, steps=20)
+        runs = [graph.random_walks(starts, steps=20, seed=seed) for seed in range(10)]
+        for cluster in graph.clusters:
+            mean = np.mean([run[cluster] for run in runs])
+            self.assertAlmostEqual(expected[cluster], mean, delta=max(10., expected[cluster] / 2))
+
+        results = graph.random_walks(starts, steps=20, seed=7, workers=2)
+        self.assertEqual(len(starts) + 20 * walkers, sum(results[cluster] for cluster in graph.walkable_clusters))
+        return
+
+    def test_stationary_distribution(self):
+        graph = self.manifold.graph
+        matrix = graph.transition_matrix
+        self.assertEqual((graph.cardinality, graph.cardinality), matrix.shape)
+        sums = np.asarray(matrix.sum(axis=1)).ravel()
+        self.assertTrue(np.allclose(sums[sums > 0], 1.))
+
+        distribution = graph.stationary_distribution(tolerance=1e-12, max_iterations=10_000)
+        walkable = np.asarray([distribution[cluster] if cluster in graph.walkable_clusters else 0. for cluster in graph.members])
+        # the distribution is a fixed point of the walk
+        self.assertLess(np.sum(np.abs(matrix.T @ walkable - walkable)[sums > 0]), 1e-6)
+        for subgraph in graph.subgraphs:
+            clusters = [cluster for cluster in subgraph.clusters if cluster in graph.walkable_clusters]
+            self.assertAlmostEqual(1., sum(distribution[cluster] for cluster in clusters), places=6)
+        return
+
     def test_replace(self):
-        self.manifold.build(
+        manifold = Manifold(self.data, 'euclidean').build(
             criterion.MaxDepth(12),
             criterion.LFDRange(80, 20),
         )
-        self.manifold.layers[-1].build_edges()
-
-        for i in range(100):
-            clusters: Dict[int, Cluster] = {c: cluster for c, cluster in zip(range(self.manifold.graph.cardinality), self.manifold.graph.clusters)}
-            if len(clusters) < 10:
-                break
-            sample_size = len(clusters) // 10
-            samples: List[int] = list(map(int, np.random.choice(self.manifold.graph.cardinality, size=sample_size, replace=False)))
-            removals: Set[Cluster] = {clusters[c] for c in samples if clusters[c].children}
-            additions: Set[Cluster] = set()
-            [additions.update(cluster.children) for cluster in removals]
-
-            self.manifold.graph.replace_clusters(
+        graph = manifold.graph
+        graph.build_edges()
+
+        for i in range(10):
+            clusters: List[Cluster] = list(graph.clusters)
+            if i % 3 == 2:
+                # replace some pairs of siblings by their parent
+                parents = {manifold.select(c.name[:c.name.rfind('0')]) for c in clusters if c.depth > 0}
+                parents = [p for p in parents if p.children and all(child in graph for child in p.children)]
+                additions: Set[Cluster] = set(parents[:len(parents) // 2 + 1])
+                removals: Set[Cluster] = {child for cluster in additions for child in cluster.children}
+            else:
+                samples: List[int] = list(map(int, np.random.choice(len(clusters), size=len(clusters) // 10 + 1, replace=False)))
+                removals: Set[Cluster] = {clusters[c] for c in samples if clusters[c].children}
+                additions: Set[Cluster] = {child for cluster in removals for child in cluster.children}
+            if not removals:
+                continue
+
+            graph.replace_clusters(
                 removals=removals,
                 additions=additions,
                 recompute_probabilities=True,
             )
 
-            clusters: Set[Cluster] = set(self.manifold.graph.clusters)
-
-            subsumed_clusters: Set[Cluster] = self.manifold.graph.cache['subsumed_clusters']
-            subsumed_edges: Dict[Cluster, Set[Edge]] = self.manifold.graph.cache['subsumed_edges']
-
-            walkable_clusters: Set[Cluster] = self.manifold.graph.cache['walkable_clusters']
-            walkable_edges: Dict[Cluster, Set[Edge]] = self.manifold.graph.cache['walkable_edges']
-
-            self.assertTrue(subsumed_clusters.issubset(clusters), f"\n1. subsumed clusters were not subset of clusters. iter: {i}")
-            self.assertTrue(walkable_clusters.issubset(clusters), f"\n2. walkable clusters were not subset of clusters. iter: {i}")
-            self.assertTrue(walkable_clusters.isdisjoint(subsumed_clusters), f"\n3. walkable clusters and subsumed clusters were not disjoint sets. iter: {i}")
-            self.assertSetEqual(clusters, subsumed_clusters.union(walkable_clusters),
-                                f"\n4. union of subsumed and walkable clusters was not the same as all clusters. iter: {i}")
-            self.assertSetEqual(clusters, set(subsumed_edges.keys()), f"\n5. keys in subsumed edges were not the same as clusters. iter: {i}")
-            self.assertSetEqual(walkable_clusters, set(walkable_edges.keys()), f"\n6. keys in walkable edges were not the same as walkable clusters. iter: {i}")
+            rebuilt = Graph(*graph.clusters).build_edges()
+            self.assertEqual(hash(rebuilt), hash(graph), f'fingerprints differed. iter: {i}')
+            self.assertEqual(rebuilt, graph, f'graphs differed. iter: {i}')
+            self.assertSetEqual(set(rebuilt.clusters), set(graph.clusters), f'clusters differed. iter: {i}')
+            self.assertSetEqual(rebuilt.walkable_clusters, graph.walkable_clusters, f'walkable clusters differed. iter: {i}')
+            self.assertSetEqual(rebuilt.subsumed_clusters, graph.subsumed_clusters, f'subsumed clusters differed. iter: {i}')
+            for cluster in graph.clusters:
+                expected = {edge.neighbor: edge for edge in rebuilt.edges[cluster]}
+                actual = {edge.neighbor: edge for edge in graph.edges[cluster]}
+                self.assertSetEqual(set(expected), set(actual), f'neighbors of {cluster} differed. iter: {i}')
+                [self.assertAlmostEqual(expected[n].distance, actual[n].distance) for n in expected]
+                if cluster in graph.walkable_clusters:
+                    expected = {edge.neighbor: edge.probability for edge in rebuilt.walkable_edges[cluster]}
+                    actual = {edge.neighbor: edge.probability for edge in graph.walkable_edges[cluster]}
+                    [self.assertAlmostEqual(expected[n], actual[n]) for n in expected]
         return
@@ -1,6 +1,9 @@
+import concurrent.futures
+import gc
 import random
 import unittest
 from tempfile import TemporaryFile
+from unittest import mock
 
 import numpy as np
 from scipy.spatial.distance import cdist
@@ -57,7 +60,26 @@ class TestManifold(unittest.TestCase):
         return
 
     def test_iter(self):
-        self.assertListEqual(self.manifold.layers, list(iter(self.manifold)))
+        self.assertListEqual(list(self.manifold.layers), list(iter(self.manifold)))
+        return
+
+    def test_layers(self):
+        layers = self.manifold.layers
+        self.assertEqual(self.manifold.depth + 1, len(layers))
+        self.assertIs(layers[-1], layers[self.manifold.depth])
+        self.assertListEqual([layers[1], layers[2]], layers[1:3])
+        with self.assertRaises(IndexError):
+            _ = layers[len(layers)]
+
+        for depth, layer in enumerate(layers):
+            self.assertListEqual(layers.clusters(depth), list(layer.clusters))
+            self.assertEqual(len(self.manifold.argpoints), layer.population)
+            self.assertTrue(all(c.depth == depth or (c.depth < depth and not c.children) for c in layer))
+
+        # layers are only kept while in use
+        del layer
+        gc.collect()
+        self.assertEqual(0, len(layers.graphs))
         return
 
     def test_str(self):
@@ -90,6 +112,150 @@ class TestManifold(unittest.TestCase):
         self.assertEqual(1, len(self.manifold.find_clusters(self.data[0], radius=0.0, depth=-1)))
         return
 
+    def test_find_approximate(self):
+        point = self.data[0] + 0.01
+        exact_points = self.manifold.find_points(point, radius=1.)
+        exact_knn = self.manifold.find_knn(point, k=10)
+
+        # with budgets large enough, the search is exact.
+        self.assertListEqual(exact_points, self.manifold.find_points(point, radius=1., max_distances=10 ** 9))
+        self.assertListEqual([d for _, d in exact_knn], [d for _, d in self.manifold.find_knn(point, k=10, max_leaves=10 ** 9)])
+        self.assertListEqual([d for _, d in exact_knn], [d for _, d in self.manifold.find_knn(point, k=10, depth=4)])
+
+        recalls = list()
+        for budget in [1, 10, 100, 1000]:
+            results = self.manifold.find_points(point, radius=1., max_distances=budget)
+            self.assertTrue(set(results).issubset(set(exact_points)))
+            results = self.manifold.find_knn(point, k=10, max_distances=budget)
+            self.assertTrue(all(d >= e for (_, d), (_, e) in zip(results, exact_knn)))
+            recalls.append(len({p for p, _ in results} & {p for p, _ in exact_knn}))
+        self.assertListEqual(sorted(recalls), recalls)
+
+        with self.assertRaises(ValueError):
+            self.manifold.find_knn(point, k=10, max_leaves=0)
+        return
+
+    def test_plan(self):
+        point = self.data[0] + 0.01
+        plan = self.manifold.plan(point, radius=0.01)
+        self.assertNotEqual('linear', plan.strategy)
+        self.assertSetEqual({'tree', 'shallow', 'linear'}, set(plan.costs.keys()))
+        self.assertLessEqual(plan.depth, self.manifold.depth)
+        self.assertEqual('linear', self.manifold.plan(point, radius=100.).strategy)
+
+        manifold = Manifold(self.data, 'euclidean').build_tree(criterion.MinPoints(5))
+        for radius in [0.01, 0.25, 1.0, 5.0]:
+            expected = manifold.find_points(point, radius)
+            plan = manifold.plan(point, radius)
+            for strategy in ['tree', 'shallow', 'linear']:
+                manifold.plan = lambda *_, s=strategy: plan._replace(strategy=s)
+                self.assertListEqual(expected, manifold.find_points(point, radius), strategy)
+            del manifold.plan
+        return
+
+    def test_freeze(self):
+        manifold = Manifold(self.data, 'euclidean').build_tree(criterion.MinPoints(5), lazy_depth=2)
+        manifold.freeze()
+        self.assertTrue(manifold.frozen)
+        self.assertIsNone(manifold.lazy_criteria)
+        self.assertIsNotNone(manifold.graph.adjacency)
+        for cluster in manifold.layers.clusters(-1):
+            self.assertIsNotNone(cluster.children)
+            self.assertIn('argmedoid', cluster.cache)
+            self.assertIn('radius', cluster.cache)
+
+        queries = self.data[:40] + 0.01
+        distances = cdist(queries, self.data, 'euclidean')
+        state = np.random.get_state()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            points = list(executor.map(lambda q: manifold.find_points(q, radius=0.5), queries))
+            knn = list(executor.map(lambda q: manifold.find_knn(q, k=5), queries))
+        # searches drew nothing from np.random.
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(state, np.random.get_state())))
+        for i in range(len(queries)):
+            self.assertSetEqual(set(np.flatnonzero(distances[i] <= 0.5)), {p for p, _ in points[i]})
+            self.assertTrue(np.allclose(np.sort(distances[i])[:5], [d for _, d in knn[i]]))
+
+        for mutate in [
+            lambda: manifold.build(criterion.MaxDepth(3)),
+            lambda: manifold.build_tree(),
+            lambda: manifold.build_graph(),
+            lambda: manifold.extend([0]),
+            lambda: manifold.delete([0]),
+            lambda: manifold.compact(),
+            lambda: manifold.graph.replace_clusters({manifold.root}, set(manifold.root.children)),
+            lambda: criterion.MinimizeSubsumed(1e-3)(manifold),
+        ]:
+            with self.assertRaises(ValueError):
+                mutate()
+        self.assertIs(manifold, manifold.freeze())
+
+        # the graph of leaves and the candidates of clusters were built by freeze, and are only read afterwards.
+        leaves = manifold.layers[-1]
+        adjacency, candidates = leaves.adjacency, {cluster: cluster.candidates for cluster in leaves}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            graphs = list(executor.map(lambda k: manifold.knn_graph(k), [3, 3, 5, 5]))
+        self.assertTrue(all((graph != graphs[0]).nnz == 0 for graph in graphs[:2]))
+        self.assertIs(leaves, manifold.layers[-1])
+        self.assertIs(adjacency, leaves.adjacency)
+        self.assertTrue(all(cluster.candidates is candidates[cluster] for cluster in leaves))
+        return
+
+    def test_find_pairs(self):
+        data = self.data[:500]
+        m = Manifold(data, 'euclidean').build_tree(criterion.MinPoints(5))
+        expected = cdist(data, data)
+        for radius in [0., 0.25, 0.5, 2.]:
+            chunks = list(m.find_pairs(radius, distances=True, chunk_size=100))
+            self.assertTrue(all(len(pairs) >= 100 for pairs, _ in chunks[:-1]))
+            pairs = np.concatenate([pairs for pairs, _ in chunks]) if chunks else np.zeros((0, 2), dtype=int)
+            distances = np.concatenate([distances for _, distances in chunks]) if chunks else np.zeros(0)
+            left, right = np.nonzero(np.triu(expected <= radius, k=1))
+            self.assertSetEqual(set(zip(left, right)), set(map(tuple, pairs)), radius)
+            self.assertEqual(len(left), len(pairs))
+            self.assertTrue(np.allclose(expected[pairs[:, 0], pairs[:, 1]], distances))
+
+        other_data = self.data[500:]
+        other = Manifold(other_data, 'euclidean').build_tree(criterion.MinPoints(5))
+        pairs = np.concatenate(list(m.find_pairs(0.5, other)))
+        left, right = np.nonzero(cdist(data, other_data) <= 0.5)
+        self.assertSetEqual(set(zip(left, right)), set(map(tuple, pairs)))
+        self.assertEqual(len(left), len(pairs))
+
+        m.delete(range(100))
+        pairs = np.concatenate(list(m.find_pairs(0.5)))
+        self.assertTrue(np.all(pairs >= 100))
+
+        with self.assertRaises(ValueError):
+            next(m.find_pairs(-1.))
+        with self.assertRaises(ValueError):
+            next(m.find_pairs(1., Manifold(data, 'cosine')))
+        return
+
+    def test_knn_graph(self):
+        data = self.data[:500]
+        m = Manifold(data, 'euclidean').build(criterion.MinPoints(3), criterion.LFDRange(60, 50))
+        expected = cdist(data, data)
+        np.fill_diagonal(expected, np.inf)
+        for k in [1, 5, 20]:
+            graph = m.knn_graph(k, workers=2)
+            self.assertEqual((500, 500), graph.shape)
+            self.assertListEqual([k] * 500, list(np.diff(graph.indptr)))
+            for i in range(500):
+                row = slice(graph.indptr[i], graph.indptr[i + 1])
+                self.assertNotIn(i, graph.indices[row])
+                self.assertTrue(np.allclose(np.sort(expected[i])[:k], graph.data[row]))
+                self.assertTrue(np.allclose(expected[i, graph.indices[row]], graph.data[row]))
+
+        m.delete(range(100))
+        graph = m.knn_graph(5)
+        self.assertEqual(0, graph[:100].nnz)
+        self.assertTrue(np.all(graph.indices >= 100))
+
+        with self.assertRaises(ValueError):
+            m.knn_graph(400)
+        return
+
     def test_build(self):
         m = Manifold(self.data, 'euclidean').build(criterion.MaxDepth(1))
         self.assertEqual(2, len(m.layers))
@@ -182,6 +348,123 @@ class TestManifold(unittest.TestCase):
                 self.assertIn('local_fractal_dimension', cluster.cache)
         return
 
+    def test_load_deleted(self):
+        data = datasets.bullseye(n=500)[0]
+        m = Manifold(data, 'euclidean').build_tree(criterion.MinPoints(5))
+        deleted = list(range(10))
+        m.delete(deleted)
+        point = data[0]
+        expected = m.find_points(point, 0.5)
+        self.assertTrue(set(deleted).isdisjoint(p for p, _ in expected))
+
+        for compact in [False, True]:
+            if compact:
+                m.compact()
+            with TemporaryFile() as fp:
+                m.dump(fp)
+                fp.seek(0)
+                loaded = Manifold.load(fp, data)
+            self.assertSetEqual(m.tombstones, loaded.tombstones)
+            self.assertSetEqual(m.removed, loaded.removed)
+            self.assertListEqual(sorted(m.argpoints), sorted(loaded.argpoints))
+            self.assertListEqual(expected, loaded.find_points(point, 0.5))
+            self.assertTrue(set(deleted).isdisjoint(p for p, _ in loaded.find_knn(point, 20)))
+
+            # extending a loaded manifold does not bring deleted points back.
+            loaded.extend()
+            if compact:
+                self.assertTrue(set(deleted).isdisjoint(loaded.root.argpoints))
+            self.assertListEqual(expected, loaded.find_points(point, 0.5))
+        return
+
+    def test_load_compacted_linear(self):
+        data = datasets.bullseye(n=500)[0]
+        m = Manifold(data, 'euclidean').build_tree(criterion.MinPoints(5))
+        m.delete(range(10)).compact()
+        with TemporaryFile() as fp:
+            m.dump(fp)
+            fp.seek(0)
+            loaded = Manifold.load(fp, data)
+        # argpoints may list rows the tree no longer holds; searches must not return them.
+        loaded.argpoints = list(range(data.shape[0]))
+
+        point, live = data[0], np.asarray(loaded.root.argpoints)
+        distances = cdist(np.asarray([point]), data[live], 'euclidean')[0]
+        plan = loaded.plan(point, 0.5)
+        loaded.plan = lambda *_: plan._replace(strategy='linear')
+        expected = sorted(((int(p), d) for p, d in zip(live, distances) if d <= 0.5), key=lambda item: item[1])
+        self.assertListEqual([p for p, _ in expected], [p for p, _ in loaded.find_points(point, 0.5)])
+
+        knn = loaded.find_knn(point, 20)
+        self.assertTrue(set(range(10)).isdisjoint(p for p, _ in knn))
+        self.assertTrue(np.allclose(sorted(distances)[:20], sorted(d for _, d in knn)))
+        return
+
+    def test_load_graphs(self):
+        original = self.manifold
+        original.graphs['layer'] = original.layers[5].build_edges()
+        original.graphs['unbuilt'] = original.layers[3]
+        with TemporaryFile() as fp:
+            original.dump(fp)
+            fp.seek(0)
+            with mock.patch.object(Manifold, 'distance', side_effect=AssertionError), \
+                    mock.patch.object(Manifold, 'paired_distance', side_effect=AssertionError):
+                loaded = Manifold.load(fp, self.data)
+        self.assertSetEqual({'layer', 'unbuilt'}, set(loaded.graphs.keys()))
+        self.assertIsNone(loaded.graphs['unbuilt'].adjacency)
+        self.assertEqual(original.graph, loaded.graph)
+        graph, restored = original.graphs['layer'], loaded.graphs['layer']
+        self.assertEqual(graph, restored)
+        self.assertSetEqual(set(graph.walkable_clusters), set(restored.walkable_clusters))
+        [self.assertTrue(np.array_equal(a, b)) for a, b in zip(graph.adjacency, restored.adjacency)]
+        self.assertTrue(np.array_equal(graph.components, restored.components))
+        original.graphs.clear()
+        return
+
+    def test_medoid_distances(self):
+        manifold = Manifold(self.data, 'euclidean').build_tree(criterion.MaxDepth(7))
+        manifold.distance_cache_size = 100
+        clusters = [cluster for layer in manifold.layers for cluster in layer]
+        left, right = clusters[:60], clusters[60:120]
+        expected = manifold.paired_distance([c.argmedoid for c in left], [c.argmedoid for c in right])
+        self.assertTrue(np.allclose(expected, manifold.medoid_distances(left, right)))
+        self.assertTrue(np.allclose(expected, manifold.medoid_distances(right, left)))
+        self.assertEqual(60, len(manifold.distance_cache))
+
+        manifold.medoid_distances(left, right[::-1])
+        self.assertEqual(100, len(manifold.distance_cache))
+        with self.assertRaises(ValueError):
+            manifold.medoid_distances(left, right[:-1])
+
+        # a second graph from the same tree reuses the distances computed for the first.
+        manifold.distance_cache_size = 1_000_000
+        manifold.root.candidates = {manifold.root: 0.}
+        manifold.layers[6].build_edges()
+        with mock.patch.object(Manifold, 'paired_distance', side_effect=AssertionError):
+            for layer in manifold.layers:
+                for cluster in layer:
+                    cluster.candidates = None
+            manifold.root.candidates = {manifold.root: 0.}
+            manifold.layers[6].build_edges()
+            manifold.layers[4].build_edges()
+
+        # medoids chosen again after clearing caches are not measured by stale distances.
+        (left, right), others = (left[-1], right[-1]), (left[0], right[0])
+        manifold.medoid_distances([left, others[0]], [right, others[1]])
+        size = len(manifold.distance_cache)
+        left.clear_cache(), right.clear_cache()
+        # only the pairs that include either cluster are evicted.
+        ids = {left.id, right.id}
+        self.assertFalse(any(key >> 32 in ids or key & 0xFFFFFFFF in ids for key in manifold.distance_cache))
+        self.assertGreater(len(manifold.distance_cache), size // 2)
+        with mock.patch.object(Manifold, 'paired_distance', side_effect=AssertionError):
+            manifold.medoid_distances([others[0]], [others[1]])
+        with mock.patch.object(left, 'cache', {'argmedoid': left.argpoints[0]}), \
+                mock.patch.object(right, 'cache', {'argmedoid': right.argpoints[-1]}):
+            expected = manifold.paired_distance([left.argpoints[0]], [right.argpoints[-1]])
+            self.assertTrue(np.allclose(expected, manifold.medoid_distances([left], [right])))
+        return
+
     def test_partition_backends(self):
         data = datasets.random(n=100, dimensions=5)[0]
         m_single = Manifold(data, 'euclidean')._partition_single([criterion.MaxDepth(5)])
@@ -205,3 +488,200 @@ class TestManifold(unittest.TestCase):
             results = m.find_knn(point, k)
             self.assertEqual(k, len(results))
             self.assertSetEqual(naive_results, {p for p, _ in results})
+
+    def test_delete(self):
+        data = datasets.bullseye(n=500)[0]
+        m = Manifold(data, 'euclidean').build(
+            criterion.MaxDepth(10),
+            criterion.LFDRange(60, 50),
+        )
+        deleted = set(map(int, np.random.choice(data.shape[0], data.shape[0] // 3, replace=False)))
+        # delete every point of one leaf so that compaction has to drop a cluster
+        leaf = next(iter(m.layers[-1]))
+        deleted.update(leaf.argpoints)
+        m.delete(list(deleted))
+
+        point = data[0]
+        distances = cdist(np.asarray([point]), data, m.metric)[0]
+        live = [p for p in range(data.shape[0]) if p not in deleted]
+        for radius in [0.1, 0.5, 1.0]:
+            naive_results = {p for p in live if distances[p] <= radius}
+            self.assertSetEqual(naive_results, {p for p, _ in m.find_points(point, radius)})
+
+        knn = {p for p, _ in m.find_knn(point, 10)}
+        self.assertTrue(knn.isdisjoint(deleted))
+        with self.assertRaises(ValueError):
+            m.find_knn(point, len(live) + 1)
+        with self.assertRaises(ValueError):
+            m.delete([data.shape[0]])
+
+        m.compact()
+        self.assertEqual(0, len(m.tombstones))
+        self.assertEqual(len(live), m.layers[-1].population)
+        self.assertEqual(len(live), m.graph.population)
+        for layer in m.layers:
+            for cluster in layer:
+                self.assertTrue(deleted.isdisjoint(cluster.argpoints))
+                self.assertTrue(cluster.argpoints)
+        self.assertNotIn(leaf, m.layers[-1])
+        for radius in [0.1, 0.5, 1.0]:
+            naive_results = {p for p in live if distances[p] <= radius}
+            self.assertSetEqual(naive_results, {p for p, _ in m.find_points(point, radius)})
+        self.assertEqual(knn, {p for p, _ in m.find_knn(point, 10)})
+        return
+
+    def test_compact_samples(self):
+        data = datasets.bullseye(n=2000)[0]
+        m = Manifold(data, 'euclidean').build_tree(criterion.MinPoints(5), lazy_depth=1)
+        cluster = max(m.root.children, key=lambda c: c.cardinality)
+        self.assertGreater(cluster.cardinality, 200)
+        # delete all but one of the samples of the cluster, and a few other points.
+        m.delete(cluster.argsamples[1:] + [p for p in cluster.argpoints if p not in cluster.argsamples][:10])
+        m.compact()
+
+        for c in [m.root, *m.root.children]:
+            self.assertGreater(c.nsamples, 1)
+            self.assertTrue(set(c.argsamples).issubset(c.argpoints))
+            self.assertIn(c.argmedoid, c.argpoints)
+            self.assertAlmostEqual(np.max(c.distance_from(c.argpoints)), c.radius)
+
+        # the cluster still splits when a search first reaches it.
+        m.find_points(data[cluster.argpoints[0]], 0.)
+        self.assertTrue(cluster.children)
+        point = data[cluster.argpoints[0]]
+        distances = cdist(np.asarray([point]), data, m.metric)[0]
+        live = set(m.root.argpoints)
+        self.assertSetEqual({p for p in live if distances[p] <= 0.5}, {p for p, _ in m.find_points(point, 0.5)})
+        return
+
+    def test_extend(self):
+        data = datasets.bullseye(n=500)[0]
+        m = Manifold(data, 'euclidean', argpoints=0.2).build(
+            criterion.MaxDepth(10),
+            criterion.LFDRange(60, 50),
+            extend=True,
+        )
+        self.assertSetEqual(set(range(data.shape[0])), set(m.argpoints))
+        self.assertEqual(data.shape[0], m.graph.population)
+        self.assertEqual(data.shape[0], m.layers[-1].population)
+        for layer in m.layers:
+            for cluster in layer:
+                distances = cluster.distance_from(cluster.argpoints)
+                self.assertLessEqual(np.max(distances), cluster.radius + 1e-12)
+
+        point = data[0]
+        distances = cdist(np.asarray([point]), data, m.metric)[0]
+        for radius in [0.1, 0.5, 1.0]:
+            naive_results = {p for p, d in enumerate(distances) if d <= radius}
+            self.assertSetEqual(naive_results, {p for p, _ in m.find_points(point, radius)})
+
+        with self.assertRaises(ValueError):
+            m.extend([0])
+
+        # points removed by compaction are not streamed back in, unless asked for.
+        m.delete([0, 1, 2]).compact().extend()
+        self.assertTrue({0, 1, 2}.isdisjoint(m.root.argpoints))
+        self.assertEqual(data.shape[0] - 3, m.layers[-1].population)
+        m.extend([0])
+        self.assertIn(0, m.root.argpoints)
+        self.assertNotIn(0, m.removed)
+        return
+
+    def test_assign(self):
+        points = np.random.randn(100, 3)
+        ids, distances = self.manifold.assign(points, distances=True)
+        self.assertEqual((100,), ids.shape)
+        for point, cluster_id, distance in zip(points, ids, distances):
+            cluster = self.manifold.clusters[cluster_id]
+            self.assertFalse(cluster.children)
+            self.assertAlmostEqual(distance, cluster.distance_from(np.asarray([point]))[0])
+
+            # descending one point at a time must end at the same cluster
+            expected = self.manifold.root
+            while expected.children:
+                children = list(expected.children)
+                expected = children[int(np.argmin([c.distance_from(np.asarray([point]))[0] for c in children]))]
+            self.assertEqual(expected, cluster)
+
+        ids = self.manifold.assign(points, depth=2)
+        self.assertTrue(all(self.manifold.clusters[i].depth <= 2 for i in ids))
+
+        ids = self.manifold.assign(points, graph=self.manifold.graph)
+        self.assertTrue(all(self.manifold.clusters[i] in self.manifold.graph for i in ids))
+
+        self.assertEqual(self.manifold.root.id, self.manifold.assign(points[0], depth=0)[0])
+        return
+
+    def test_lazy_build(self):
+        data = datasets.bullseye(n=500)[0]
+        m = Manifold(data, 'euclidean').build(
+            criterion.MaxDepth(12),
+            criterion.MinPoints(10),
+            lazy_depth=3,
+        )
+        self.assertEqual(3, m.depth)
+        self.assertTrue(all((cluster.children is None for cluster in m.layers[-1] if cluster.depth == 3)))
+
+        points = np.random.choice(data.shape[0], 20, replace=False)
+        distances = cdist(data[points], data, m.metric)
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            results = list(executor.map(lambda p: m.find_points(data[p], 0.1), points))
+        for row, result in zip(distances, results):
+            self.assertSetEqual({p for p, d in enumerate(row) if d <= 0.1}, {p for p, _ in result})
+
+        # searches reached below the depth built up front
+        self.assertGreater(max(cluster.depth for cluster in m.find_clusters(data[points[0]], 0., -1)), 3)
+
+        # an eager build afterwards completes the tree.
+        m.build_tree(criterion.MaxDepth(12), criterion.MinPoints(10))
+        self.assertIsNone(m.lazy_criteria)
+        self.assertLessEqual(m.depth, 12)
+        self.assertEqual(data.shape[0], m.layers[-1].population)
+        for leaf in m.layers[-1]:
+            self.assertIsNotNone(leaf.children)
+            self.assertTrue(leaf.depth == 12 or leaf.cardinality <= 10 or leaf.nsamples == 1)
+        return
+
+    def test_lazy_threaded(self):
+        data = datasets.bullseye(n=5000)[0]
+        m = Manifold(data, 'euclidean').build_tree(criterion.MinPoints(5), lazy_depth=1)
+        points = np.random.choice(data.shape[0], 64, replace=False)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(lambda p: m.find_knn(data[p], 5), points))
+
+            # a cluster being expanded does not hold up expansions in other subtrees.
+            unexpanded = [c for c in m.clusters if c.children is None]
+            left, right = unexpanded[:2]
+            with left.lock:
+                executor.submit(m._expand, right).result(timeout=60)
+                self.assertIsNone(left.children)
+                self.assertIsNotNone(right.children)
+
+        # radii stay valid for the medoids that were cached with them.
+        clusters = [m.root]
+        while clusters:
+            cluster = clusters.pop()
+            distances = cluster.distance_from(cluster.argpoints)
+            self.assertLessEqual(np.max(distances), cluster.radius + 1e-12, cluster)
+            clusters.extend(cluster.children or [])
+        return
+
+    def test_lazy_extend(self):
+        data = datasets.bullseye(n=1000)[0]
+        m = Manifold(data, 'euclidean', argpoints=0.3).build_tree(criterion.MinPoints(5), lazy_depth=2)
+        [m.find_points(data[p], 0.1) for p in m.argpoints[:50]]
+        self.assertGreater(max(cluster.depth for cluster in m.find_clusters(data[m.argpoints[0]], 0., -1)), 2)
+        m.extend()
+
+        clusters = [m.root]
+        while clusters:
+            cluster = clusters.pop()
+            if cluster.children:
+                self.assertListEqual(sorted(cluster.argpoints), sorted(p for c in cluster.children for p in c.argpoints))
+                clusters.extend(cluster.children)
+
+        points = np.random.choice(data.shape[0], 20, replace=False)
+        distances = cdist(data[points], data, m.metric)
+        for p, row in zip(points, distances):
+            self.assertSetEqual({q for q, d in enumerate(row) if d <= 0.1}, {q for q, _ in m.find_points(data[p], 0.1)})
+        return
@@ -0,0 +1,106 @@
+import unittest
+
+import numpy as np
+
+from pyclam import datasets, criterion, scoring
+from pyclam.manifold import Manifold, Graph
+
+
+class TestScoring(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        np.random.seed(42)
+        cls.data, _ = datasets.bullseye(n=500, num_rings=2)
+        cls.manifold = Manifold(cls.data, 'euclidean')
+        cls.manifold.build(
+            criterion.MaxDepth(10),
+            criterion.LFDRange(60, 50),
+        )
+        cls.manifold.graphs['leaves'] = cls.manifold.layers[-1]
+        cls.manifold.graphs['layer'] = cls.manifold.layers[6]
+        return
+
+    def test_measures(self):
+        graph = self.manifold.graph
+        for name, measure in scoring.MEASURES.items():
+            values = measure(graph, seed=42)
+            self.assertEqual(graph.cardinality, len(values), name)
+
+        values = scoring.cardinality(graph)
+        self.assertEqual(-min(c.cardinality for c in graph.clusters), np.max(values))
+        values = scoring.neighborhood(graph, hops=1)
+        for cluster, value in zip(graph.members, values):
+            self.assertEqual(-(1 + len(graph.neighbors(cluster))), value)
+        values = scoring.neighborhood(graph, hops=2)
+        for cluster, value in zip(graph.members, values):
+            reached = {cluster}.union(graph.neighbors(cluster))
+            reached.update({n for c in list(reached) for n in graph.neighbors(c)})
+            self.assertEqual(-len(reached), value)
+        values = scoring.component_cardinality(graph)
+        for cluster, value in zip(graph.members, values):
+            self.assertEqual(-graph.subgraph(cluster).cardinality, value)
+        return
+
+    def test_normalize(self):
+        values = np.random.randn(100)
+        for normalization in scoring.NORMALIZATIONS:
+            normalized = scoring.normalize(values, normalization)
+            self.assertTrue(np.all((0. <= normalized) & (normalized <= 1.)), normalization)
+            self.assertListEqual(list(np.argsort(values)), list(np.argsort(normalized)), normalization)
+            self.assertTrue(np.all(scoring.normalize(np.ones(10), normalization) == 0.5))
+        with self.assertRaises(ValueError):
+            scoring.normalize(values, 'unknown')
+        return
+
+    def test_point_scores(self):
+        graph = self.manifold.graph
+        scores = np.arange(graph.cardinality, dtype=np.float64)
+        points = scoring.point_scores(graph, scores)
+        self.assertEqual(self.data.shape[0], len(points))
+        for cluster, value in zip(graph.members, scores):
+            self.assertTrue(np.all(points[cluster.argpoints] == value))
+
+        self.assertEqual(0, len(scoring.point_scores(Graph(), np.zeros(shape=(0,)))))
+        return
+
+    def test_score(self):
+        scores = scoring.score(self.manifold, seed=42)
+        self.assertEqual(self.data.shape[0], len(scores))
+        self.assertFalse(np.any(np.isnan(scores)))
+        self.assertTrue(np.all((0. <= scores) & (scores <= 1.)))
+
+        threaded = scoring.score(self.manifold, seed=42, workers=3)
+        self.assertTrue(np.allclose(scores, threaded))
+
+        maximum = scoring.score(self.manifold, measures=['cardinality', 'neighborhood'], voting='max')
+        self.assertTrue(np.all(maximum >= scoring.score(self.manifold, measures=['cardinality', 'neighborhood'])))
+        with self.assertRaises(ValueError):
+            scoring.score(self.manifold, measures=['unknown'])
+        with self.assertRaises(ValueError):
+            scoring.score(self.manifold, voting='unknown')
+        return
+
+    def test_scorer(self):
+        graph = self.manifold.graph
+        scorer = self.manifold.scorer(measures=['cardinality', 'stationary'])
+        points = self.data[:200]
+        scores = scorer.score(points)
+        self.assertEqual(200, len(scores))
+        self.assertFalse(np.any(np.isnan(scores)))
+
+        details = scorer.scores(points)
+        self.assertSetEqual({'cluster', 'component', 'cardinality', 'stationary'}, set(details.keys()))
+        self.assertTrue(np.allclose(scores, (details['cardinality'] + details['stationary']) / 2))
+        expected = scoring.cluster_scores(graph, ['cardinality'])['cardinality']
+        for i, cluster_id in enumerate(details['cluster']):
+            cluster = self.manifold.clusters[cluster_id]
+            self.assertIn(cluster, graph)
+            self.assertEqual(graph.components[graph.index[cluster]], details['component'][i])
+            self.assertEqual(expected[graph.index[cluster]], details['cardinality'][i])
+
+        # points that fall into their own cluster score the same as in batch scoring.
+        batch = scoring.score(self.manifold, [graph], measures=['cardinality', 'stationary'])
+        own = [i for i, cluster_id in enumerate(details['cluster']) if i in self.manifold.clusters[cluster_id].argpoints]
+        self.assertGreater(len(own), 0)
+        self.assertTrue(np.allclose(batch[own], scores[own]))
+        return
@@ -10,3 +10,5 @@ DistanceFunc = Callable[[Data, Data], Radius]
 Metric = Union[str, DistanceFunc]
 Edge = namedtuple('Edge', 'neighbor distance probability')
 CacheEdge = namedtuple('CacheEdge', 'source neighbor distance probability')
+Adjacency = namedtuple('Adjacency', 'indptr indices distances probabilities')
+Plan = namedtuple('Plan', 'strategy depth clusters candidates costs')